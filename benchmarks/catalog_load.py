@@ -0,0 +1,105 @@
+"""
+Compares loading the design catalogs from the cloudpickle files of the earlier versions with loading them from
+CatalogStore: load time and the memory allocated while loading and kept afterwards.
+
+Usage: python benchmarks/catalog_load.py [--items 5000] [--characters 2000] [--repeat 20]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cloudpickle as pickle
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog_store import CatalogStore
+
+STATS = ["Hp", "Attack", "Pilot", "Science", "Engine", "Weapon", "Repair", "Ability", "Stamina", "FireResistance"]
+
+
+def make_items(count: int) -> pd.DataFrame:
+    """
+    Builds an ItemDesign-like frame: a few dozen text columns, ids, prices and enhancements.
+    """
+    frame = {
+        "ItemDesignId": np.arange(1, count + 1),
+        "ItemDesignName": [f"Item {i}" for i in range(count)],
+        "ItemDesignDescription": [" ".join(random.choices(STATS, k=random.randrange(5, 30))) for _ in range(count)],
+        "Rarity": random.choices(["Common", "Elite", "Unique", "Epic", "Hero", "Special", "Legendary"], k=count),
+        "ItemSubType": random.choices(["EquipmentHead", "EquipmentBody", "EquipmentWeapon", "None"], k=count),
+        "EnhancementType": random.choices(STATS + ["None"], k=count),
+        "EnhancementValue": np.round(np.random.uniform(0, 20, count), 1),
+        "MarketPrice": np.where(np.random.rand(count) < 0.3, np.nan, np.random.randint(1, 5000, count)),
+    }
+    for column in range(40):
+        frame[f"Text{column}"] = random.choices(["None", "Default", "0", ""], k=count)
+    for column in range(20):
+        frame[f"Value{column}"] = np.random.randint(0, 1000, count)
+    return pd.DataFrame(frame)
+
+
+def make_characters(count: int) -> pd.DataFrame:
+    """
+    Builds a CharacterDesign-like frame: names and an initial and final value of every stat.
+    """
+    frame = {
+        "CharacterDesignId": np.arange(1, count + 1),
+        "CharacterDesignName": [f"Crew {i}" for i in range(count)],
+        "Rarity": random.choices(["Common", "Elite", "Unique", "Epic", "Legendary"], k=count),
+    }
+    for stat in STATS:
+        frame[stat] = np.random.uniform(0, 50, count)
+        frame[f"Final{stat}"] = frame[stat] * 4
+    for column in range(60):
+        frame[f"Value{column}"] = np.random.randint(0, 1000, count)
+    return pd.DataFrame(frame)
+
+
+def measure(load, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        load()
+        timings.append(time.perf_counter() - started)
+    tracemalloc.start()
+    df = load()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del df
+    return statistics.median(timings), peak, retained
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=5000)
+    parser.add_argument("--characters", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_path:
+        for name, df in (("items", make_items(args.items)), ("characters", make_characters(args.characters))):
+            filename = os.path.join(data_path, f"{name}.pickle")
+            with open(filename, "wb") as outfile:
+                pickle.dump(df, outfile)
+            store = CatalogStore(os.path.join(data_path, name))
+            store.save(df)
+
+            def load_pickle():
+                with open(filename, "rb") as infile:
+                    return pickle.load(infile)
+
+            for label, load in (("cloudpickle", load_pickle), ("catalog", store.load)):
+                seconds, peak, retained = measure(load, args.repeat)
+                print(f"{name:>10} {label:>11}: {seconds * 1000:7.2f} ms, peak {peak / 1e6:6.2f} MB, "
+                      f"retained {retained / 1e6:6.2f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Measures the latency of Database.get_sold_price_summary (the /price command) while the sold listings grow.
+Listings are spread over the last `--days` days and the ones older than `--retention-days` are rolled into
+market_sold_daily with Database.compact_sold, so the queries read both raw and rollup rows.
+
+Usage: python benchmarks/price_query.py [--sizes 10000 100000 1000000] [--queries 200] [--days 120]
+       [--retention-days 30]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import Database
+
+STATS = ["Weapon", "Ability", "Science", "Hp", "Stamina", "Attack", "FireResistance", "Engine", "Pilot", "Repair"]
+ITEMS = 500
+
+
+def fill(db: Database, start: int, count: int, days: int):
+    now = int(time.time())
+    rows = []
+    for listing_id in range(start, start + count):
+        listing_time = now - random.randrange(days * 24 * 3600)
+        rows.append((listing_id, random.randrange(ITEMS), random.choice(STATS), round(random.uniform(0.1, 10), 1),
+                     random.randrange(100, 5000), listing_time, random.randrange(60, 86400)))
+    with db.connection:
+        db.connection.executemany("INSERT INTO market_sold VALUES(?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+def count_rows(db: Database, table: str) -> int:
+    return db.connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def measure(db: Database, queries: int) -> list:
+    timings = []
+    for _ in range(queries):
+        started = time.perf_counter()
+        db.get_sold_price_summary(random.randrange(ITEMS), random.choice(STATS), round(random.uniform(0.5, 9), 1))
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--days", type=int, default=120)
+    parser.add_argument("--retention-days", type=int, default=30)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_path:
+        db = Database(data_path)
+        for table, condition in (("market_sold", "off_stat_amount > ? AND off_stat_amount < ?"),
+                                 ("market_sold_daily", "amount_bucket > ? AND amount_bucket < ?")):
+            plan = db.connection.execute(
+                f"EXPLAIN QUERY PLAN SELECT * FROM {table} WHERE item_id = ? AND off_stat = ? AND {condition}",
+                (1, "Hp", 1.0, 2.0)).fetchall()
+            print(f"Query plan on {table}:", "; ".join(row[-1] for row in plan))
+
+        rows = 0
+        for size in sorted(args.sizes):
+            fill(db, rows, size - rows, args.days)
+            rows = size
+            db.compact_sold(args.retention_days * 24 * 3600)
+            timings = measure(db, args.queries)
+            print(f"{rows:>10} sold ({count_rows(db, 'market_sold')} raw, "
+                  f"{count_rows(db, 'market_sold_daily')} rollup rows): median "
+                  f"{statistics.median(timings) * 1000:.2f} ms, "
+                  f"p95 {sorted(timings)[int(len(timings) * 0.95)] * 1000:.2f} ms")
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
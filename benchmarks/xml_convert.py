@@ -0,0 +1,80 @@
+"""
+Compares utils.convert.raw_xml_to_dict (lxml, single pass, lazy *Xml attributes) with the previous ElementTree
+implementation on large PSS-like payloads.
+
+Usage: python benchmarks/xml_convert.py [--sizes 1000 10000 50000] [--repeat 5]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from collections.abc import Mapping
+from xml.sax.saxutils import quoteattr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.convert import raw_xml_to_dict, raw_xml_to_dict_etree
+
+STATS = ["Weapon", "Ability", "Science", "Hp", "Stamina", "Attack", "FireResistance", "Engine", "Pilot", "Repair"]
+
+
+def make_payload(count: int) -> str:
+    """
+    Builds a CharacterService-like response with `count` entities, each with nested children and an embedded
+    XML document in an attribute.
+    """
+    random.seed(count)
+    entities = []
+    for design_id in range(1, count + 1):
+        animation = f'<AnimationList><Animation AnimationId="{design_id}" Frames="{random.randrange(1, 20)}"/></AnimationList>'
+        parts = "".join(f'<CharacterPart CharacterPartId="{design_id * 10 + part}" PartType="{part}"/>'
+                        for part in range(3))
+        entities.append(
+            f'<CharacterDesign CharacterDesignId="{design_id}" CharacterDesignName="Crew {design_id}" '
+            f'Rarity="Common" SpecialAbilityType="{random.choice(STATS)}" Hp="{random.randrange(1, 30)}" '
+            f'FinalHp="{random.randrange(30, 90)}" AnimationXml={quoteattr(animation)}>'
+            f'<CharacterParts>{parts}</CharacterParts></CharacterDesign>')
+    return ('<?xml version="1.0" encoding="utf-8"?><CharacterService><ListAllCharacterDesigns2><CharacterDesigns>'
+            + "".join(entities) + '</CharacterDesigns></ListAllCharacterDesigns2></CharacterService>')
+
+
+def materialize(value):
+    if isinstance(value, Mapping):
+        return {key: materialize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [materialize(item) for item in value]
+    return value
+
+
+def measure(function, payload: str, repeat: int) -> list:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(payload)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        payload = make_payload(size)
+        if materialize(raw_xml_to_dict(payload)) != raw_xml_to_dict_etree(payload):
+            raise AssertionError(f"Converters disagree on a payload of {size} entities")
+
+        etree_timings = measure(raw_xml_to_dict_etree, payload, args.repeat)
+        lxml_timings = measure(raw_xml_to_dict, payload, args.repeat)
+        etree_median = statistics.median(etree_timings)
+        lxml_median = statistics.median(lxml_timings)
+        print(f"{size:>7} entities ({len(payload) / 1e6:.1f} MB): ElementTree {etree_median * 1000:.1f} ms, "
+              f"lxml {lxml_median * 1000:.1f} ms, speedup {etree_median / lxml_median:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
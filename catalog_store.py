@@ -0,0 +1,231 @@
+import json
+import logging as log
+import numbers
+import os
+import shutil
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import cloudpickle as pickle
+import numpy as np
+import pandas as pd
+
+
+class CatalogStore:
+    """
+    Versioned columnar store for a design catalog, such as the item or character designs.
+
+    Every save writes a new version directory and then atomically points the CURRENT file at it. Columns of the
+    same numeric or date dtype are stored together as one (columns, rows) .npy array, which is memory-mapped on
+    load. Text columns are dictionary encoded: a NUL separated UTF-8 file of the distinct strings of all text
+    columns and one (columns, rows) array of codes into it, -1 for missing values. Object columns that also
+    hold numbers or booleans are encoded the same way with every value as JSON, so they load back as the same
+    types. manifest.json maps the column names to them.
+    Older versions are removed after a save, except for the KEEP_VERSIONS newest ones.
+    """
+    FORMAT_VERSION = 1
+    KEEP_VERSIONS = 2
+    CURRENT = "CURRENT"
+    MANIFEST = "manifest.json"
+    TEXT_VALUES = "text_values.txt"
+    TEXT_SEPARATOR = "\0"
+    TEXT_CODES = "text_codes.npy"
+
+    def __init__(self, path: str):
+        self._path = path
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def _current_version(self) -> Optional[str]:
+        try:
+            with open(os.path.join(self._path, self.CURRENT)) as infile:
+                return infile.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _read_manifest(self) -> Optional[Dict[str, Any]]:
+        version = self._current_version()
+        if version is None:
+            return None
+        try:
+            with open(os.path.join(self._path, version, self.MANIFEST)) as infile:
+                manifest = json.load(infile)
+        except (OSError, ValueError) as e:
+            log.warning(f"Catalog {self._path} version {version} is unreadable: {e}")
+            return None
+        if manifest.get("format") != self.FORMAT_VERSION:
+            log.info(f"Catalog {self._path} has format {manifest.get('format')}, expected {self.FORMAT_VERSION}")
+            return None
+        return manifest
+
+    def exists(self) -> bool:
+        return self._read_manifest() is not None
+
+    @property
+    def metadata(self) -> Dict[str, Any]:
+        """
+        Metadata saved with the current version, e.g. the design version it was fetched at.
+        """
+        manifest = self._read_manifest()
+        return manifest["metadata"] if manifest else {}
+
+    def load(self) -> Optional[pd.DataFrame]:
+        """
+        Returns the current version of the catalog, None if there is none or it cannot be read. A version that
+        cannot be read is invalidated, so that it is fetched and saved again.
+
+        Numeric and date columns are read-only views of the memory-mapped files, copy the frame before
+        modifying it in place.
+        """
+        manifest = self._read_manifest()
+        if manifest is None:
+            return None
+        directory = os.path.join(self._path, manifest["version"])
+        try:
+            blocks = {name: np.load(os.path.join(directory, filename), mmap_mode="r")
+                      for name, filename in manifest["blocks"].items()}
+            # the None appended to the distinct strings is what the missing value code -1 picks
+            with open(os.path.join(directory, self.TEXT_VALUES), encoding="utf-8") as infile:
+                text = infile.read()
+            distinct = text.split(self.TEXT_SEPARATOR) if manifest["text_values"] else []
+            text_values = np.array(distinct + [None], dtype=object)
+            text_codes = np.load(os.path.join(directory, self.TEXT_CODES), mmap_mode="r")
+            columns = {}
+            for column in manifest["columns"]:
+                if column["kind"] == "text":
+                    columns[column["name"]] = text_values[text_codes[column["index"]]]
+                elif column["kind"] == "json":
+                    columns[column["name"]] = _to_object_array(
+                        [None if value is None else json.loads(value)
+                         for value in text_values[text_codes[column["index"]]]])
+                else:
+                    columns[column["name"]] = blocks[column["block"]][column["index"]]
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            log.warning(f"Failed to load catalog {self._path} version {manifest['version']}: {e}")
+            self.invalidate()
+            return None
+        return pd.DataFrame(columns, index=pd.RangeIndex(manifest["rows"]), copy=False)
+
+    def save(self, df: pd.DataFrame, metadata: Optional[Dict[str, Any]] = None):
+        """
+        Stores `df` as a new version and makes it the current one.
+
+        Raises TypeError if an object column holds values other than strings, numbers and booleans.
+        """
+        columns = []
+        blocks: Dict[str, List[np.ndarray]] = {}
+        texts: List[np.ndarray] = []
+        for name in df.columns:
+            series = df[name]
+            if series.dtype.kind in "biufM":
+                values = series.to_numpy()
+                block = blocks.setdefault(values.dtype.str, [])
+                columns.append({"name": str(name), "kind": "array", "block": values.dtype.str, "index": len(block)})
+                block.append(values)
+            else:
+                values = [None if missing else value for value, missing in zip(series, series.isna())]
+                if all(value is None or isinstance(value, str) for value in values):
+                    kind = "text"
+                else:
+                    kind = "json"
+                    values = [None if value is None else _to_json(name, value) for value in values]
+                columns.append({"name": str(name), "kind": kind, "index": len(texts)})
+                texts.append(_to_object_array(values))
+
+        os.makedirs(self._path, exist_ok=True)
+        version = f"v{time.time_ns()}"
+        directory = os.path.join(self._path, version)
+        temporary = directory + ".tmp"
+        os.makedirs(temporary)
+
+        block_files = {}
+        for number, (dtype, values) in enumerate(blocks.items()):
+            block_files[dtype] = f"block{number}.npy"
+            np.save(os.path.join(temporary, block_files[dtype]), np.stack(values))
+        codes, distinct = pd.factorize(np.concatenate(texts) if texts else np.array([], dtype=object))
+        with open(os.path.join(temporary, self.TEXT_VALUES), "w", encoding="utf-8") as outfile:
+            outfile.write(self.TEXT_SEPARATOR.join(distinct))
+        np.save(os.path.join(temporary, self.TEXT_CODES), codes.astype(np.int32).reshape(len(texts), len(df)))
+
+        manifest = {
+            "format": self.FORMAT_VERSION,
+            "version": version,
+            "rows": len(df),
+            "saved": time.time(),
+            "metadata": metadata or {},
+            "blocks": block_files,
+            "text_values": len(distinct),
+            "columns": columns,
+        }
+        with open(os.path.join(temporary, self.MANIFEST), "w") as outfile:
+            json.dump(manifest, outfile)
+        os.rename(temporary, directory)
+
+        current = os.path.join(self._path, self.CURRENT)
+        with open(current + ".tmp", "w") as outfile:
+            outfile.write(version)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(current + ".tmp", current)
+        self._remove_old_versions()
+
+    def invalidate(self):
+        """
+        Drops the current version, so that the next setup fetches the catalog again.
+        """
+        try:
+            os.remove(os.path.join(self._path, self.CURRENT))
+        except FileNotFoundError:
+            pass
+
+    def _remove_old_versions(self):
+        current = self._current_version()
+        versions = sorted((entry for entry in os.listdir(self._path) if entry.startswith("v")),
+                          key=lambda entry: int(entry[1:].split(".")[0]))
+        for entry in versions[:-self.KEEP_VERSIONS]:
+            if entry != current:
+                shutil.rmtree(os.path.join(self._path, entry), ignore_errors=True)
+
+
+def _to_object_array(values: List[Any]) -> np.ndarray:
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def _to_json(column: Any, value: Any) -> str:
+    if isinstance(value, np.generic):
+        value = value.item()
+    if not isinstance(value, (str, bool, numbers.Number)):
+        raise TypeError(f"Column {column} holds {type(value).__name__} values, which the catalog cannot store")
+    return json.dumps(value)
+
+
+async def load_or_fetch(store: CatalogStore, fetch: Callable[[], Awaitable[Optional[pd.DataFrame]]],
+                        legacy_filename: Optional[str] = None,
+                        fetch_metadata: Optional[Callable[[], Awaitable[Dict[str, Any]]]] = None
+                        ) -> Optional[pd.DataFrame]:
+    """
+    Loads a catalog from `store`, or from the cloudpickle file of the earlier versions, or else fetches it.
+    Catalogs that were not in the store yet are saved to it. Fetched catalogs are saved with the metadata from
+    `fetch_metadata`, which is queried before the catalog itself so that it never claims a newer state.
+    """
+    metadata: Dict[str, Any] = {}
+    df = store.load()
+    if df is not None:
+        return df
+    if legacy_filename is not None and os.path.exists(legacy_filename):
+        with open(legacy_filename, "rb") as infile:
+            df = pickle.load(infile)
+        log.info(f"Migrating {legacy_filename} to catalog {store.path}")
+    else:
+        if fetch_metadata is not None:
+            metadata = await fetch_metadata()
+        df = await fetch()
+    if df is not None:
+        store.save(df, metadata)
+        if legacy_filename is not None and os.path.exists(legacy_filename):
+            os.remove(legacy_filename)
+    return df
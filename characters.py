@@ -1,32 +1,105 @@
-from typing import Optional
+from typing import Any, Dict, List, NamedTuple, Optional
 from pss_api import PSSApi
-import cloudpickle as pickle
+from catalog_store import CatalogStore, load_or_fetch
 import os
+import asyncio
+import logging as log
+import numpy as np
 import pandas as pd
 
+
+class StatTable(NamedTuple):
+    """
+    Initial and final stats of the character designs, in a (character design, stat, initial/final) array.
+    """
+    design_index: pd.Index
+    stat_index: Dict[str, int]
+    stats: np.ndarray
+
+
 class Characters:
+    MAX_LEVEL = 40.
+
     def __init__(self, data_path, api: PSSApi):
-        self._filename = os.path.join(data_path, "characters", f"df")
+        self._legacy_filename = os.path.join(data_path, "characters", f"df")
+        self._catalog = CatalogStore(os.path.join(data_path, "characters", "catalog"))
         self._api = api
         self._characters: pd.DataFrame = None
-    
+        self._table: Optional[StatTable] = None
+        self._design_version: Optional[int] = None
+
+    @property
+    def is_cached(self) -> bool:
+        """
+        Whether setup() can load the designs from disk instead of the API.
+        """
+        return self._catalog.exists() or os.path.exists(self._legacy_filename)
+
     async def setup(self):
-        if os.path.exists(self._filename):
-            with open(self._filename, "rb") as infile:
-                self._characters = pickle.load(infile)
-        else:
-            self._characters = await self._api.get_characters()
-            os.makedirs(os.path.dirname(self._filename), exist_ok=True)
-            with open(self._filename, "wb") as outfile:
-                pickle.dump(self._characters, outfile)
+        self._characters = await load_or_fetch(self._catalog, self._api.get_characters, self._legacy_filename,
+                                               fetch_metadata=self._fetch_metadata)
+        self._table = self._build_stat_table(self._characters)
+        self._design_version = self._catalog.metadata.get("design_version")
+
+    async def _fetch_metadata(self) -> Dict[str, Any]:
+        """
+        Catalog metadata for a fresh fetch: the current character design version, so that the refresher does not
+        fetch the same designs again.
+        """
+        version = await self._api.get_design_version("CharacterDesignVersion")
+        return {"design_version": version} if version is not None else {}
+
+    @property
+    def design_version(self) -> Optional[int]:
+        """
+        CharacterDesignVersion of the loaded designs, None if it is not known.
+        """
+        return self._design_version
+
+    async def refresh(self, design_version: int) -> bool:
+        """
+        Fetches the character designs again and swaps in the new stat table at once, so that lookups keep
+        using the previous one until then.
+        """
+        characters = await self._api.get_characters()
+        if characters is None or len(characters) == 0:
+            return False
+        loop = asyncio.get_running_loop()
+        table = await loop.run_in_executor(None, self._build_stat_table, characters)
+        await loop.run_in_executor(None, self._catalog.save, characters, {"design_version": design_version})
+        log.info(f"Character designs updated to version {design_version}: "
+                 f"{len(self._table.design_index)} -> {len(table.design_index)} designs")
+        self._characters, self._table = characters, table
+        self._design_version = design_version
+        return True
+
+    @staticmethod
+    def _build_stat_table(characters: pd.DataFrame) -> StatTable:
+        """
+        Builds a (character design, stat, initial/final) array of every stat that has a Final<stat> column.
+        """
+        characters = characters.drop_duplicates(subset="CharacterDesignId")
+        stat_names: List[str] = [column for column in characters.columns if f"Final{column}" in characters.columns]
+        final_names = [f"Final{stat}" for stat in stat_names]
+
+        stats = np.zeros((len(characters), len(stat_names), 2))
+        stats[:, :, 0] = characters[stat_names].to_numpy(dtype=float)
+        stats[:, :, 1] = characters[final_names].to_numpy(dtype=float)
+
+        return StatTable(design_index=pd.Index(characters["CharacterDesignId"].astype("int64")),
+                         stat_index={stat: index for index, stat in enumerate(stat_names)},
+                         stats=stats)
 
     def get_stat_at_level(self, character_id: int, level: int, stat: str) -> float:
-        row = self._characters[self._characters["CharacterDesignId"] == character_id].iloc[0]
-        if not row.empty:
-            initial = row[stat]
-            final = row[f"Final{stat}"]
-            gain = float(level) / 40.
-            range = final - initial
-            return initial + range * gain
-        else:
-            return 0
\ No newline at end of file
+        return float(self.stats_at_levels([character_id], [level], stat)[0])
+
+    def stats_at_levels(self, design_ids, levels, stat: str) -> np.ndarray:
+        """
+        Returns the value of `stat` for each pair of character design id and level, 0 for unknown designs.
+        """
+        table = self._table
+        rows = table.design_index.get_indexer(np.asarray(design_ids, dtype="int64"))
+        initial = table.stats[rows, table.stat_index[stat], 0]
+        final = table.stats[rows, table.stat_index[stat], 1]
+        gain = np.asarray(levels, dtype=float) / self.MAX_LEVEL
+        return np.where(rows >= 0, initial + (final - initial) * gain, 0.)
@@ -1,17 +1,65 @@
+import asyncio
 import datetime
+import functools
+import math
 import sqlite3
 import os
 import datetime
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional, Tuple
 
 import pandas as pd
 
+from price_sketch import PriceSketch
+
+ListingRow = Tuple[int, int, Optional[str], Optional[float], int, datetime.datetime]
+
+LISTING_MAX_AGE_SECONDS = 24 * 3600
+
 
 class Database:
+    # Schema migrations applied in order after the tables are created, the number of applied ones is stored
+    # in PRAGMA user_version
+    MIGRATIONS = [
+        [
+            # Covers get_sold_price_summary, so /price only reads the index range of one item and stat
+            "CREATE INDEX IF NOT EXISTS market_sold_price ON market_sold "
+            "(item_id, off_stat, off_stat_amount, price, listing_time, listing_duration_seconds)",
+            # Listing pruning
+            "CREATE INDEX IF NOT EXISTS market_listings_time ON market_listings (listing_time)",
+        ],
+        [
+            # Daily price rollups of compacted market_sold rows, see compact_sold
+            "CREATE TABLE IF NOT EXISTS market_sold_daily ("
+            "item_id INTEGER,"
+            "off_stat TEXT,"
+            "amount_bucket INTEGER,"
+            "day INTEGER,"
+            "count INTEGER,"
+            "price_sum INTEGER,"
+            "price_sum_sq REAL,"
+            "price_min INTEGER,"
+            "price_max INTEGER,"
+            "sketch TEXT,"
+            "PRIMARY KEY (item_id, off_stat, amount_bucket, day)"
+            ")",
+            "CREATE INDEX IF NOT EXISTS market_sold_time ON market_sold (listing_time)",
+        ],
+    ]
+    # Width of the off_stat_amount buckets of market_sold_daily
+    AMOUNT_BUCKETS_PER_UNIT = 10
 
-    def __init__(self, data_path: str):
-        self.connection = sqlite3.connect(os.path.join(data_path, "database.db"))
-        self._create_tables()
+    def __init__(self, data_path: str, create_tables: bool = True):
+        self.connection = sqlite3.connect(os.path.join(data_path, "database.db"), timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        if create_tables:
+            self._create_tables()
+
+    def close(self):
+        self.connection.close()
 
     def _create_tables(self):
         cursor = self.connection.cursor()
@@ -38,19 +86,52 @@ class Database:
             ")"
         )
 
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS sales ("
+            "sale_id INTEGER PRIMARY KEY,"
+            "item_id INTEGER,"
+            "quantity INTEGER,"
+            "currency_type TEXT,"
+            "currency_value INTEGER,"
+            "status_time INTEGER"
+            ")"
+        )
+        cursor.execute("CREATE INDEX IF NOT EXISTS sales_item_time ON sales (item_id, status_time)")
+
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS sales_coverage ("
+            "item_id INTEGER PRIMARY KEY,"
+            "oldest_time INTEGER"
+            ")"
+        )
+        self._migrate()
+
+    def _migrate(self):
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        for number, statements in enumerate(self.MIGRATIONS[version:], start=version + 1):
+            with self.connection:
+                for statement in statements:
+                    self.connection.execute(statement)
+                self.connection.execute(f"PRAGMA user_version = {number}")
+
     def insert_market_listing(self, listing_id: int, item_id: int, off_stat: str, off_stat_amount: float, price: int,
                               listing_time: datetime.datetime):
-        cursor = self.connection.cursor()
-        cursor.execute(f"INSERT OR IGNORE INTO market_listings VALUES("
-                       f"{listing_id},"
-                       f"{item_id},"
-                       f"'{off_stat}',"
-                       f"{off_stat_amount},"
-                       f"{price},"
-                       f"{int(listing_time.timestamp())}"
-                       f")")
-        cursor.execute(f"DELETE FROM market_listings WHERE listing_time < {int(datetime.datetime.utcnow().timestamp()) - 3600*24}")
-        self.connection.commit()
+        self.insert_market_listings([(listing_id, item_id, off_stat, off_stat_amount, price, listing_time)])
+
+    def insert_market_listings(self, rows: Iterable[ListingRow]):
+        """
+        Inserts listings given as (listing_id, item_id, off_stat, off_stat_amount, price, listing_time) tuples
+        in one transaction.
+        """
+        params = [(int(listing_id), int(item_id), off_stat, off_stat_amount, int(price), int(listing_time.timestamp()))
+                  for listing_id, item_id, off_stat, off_stat_amount, price, listing_time in rows]
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO market_listings VALUES(?, ?, ?, ?, ?, ?)", params)
+
+    def prune_listings(self, max_age_seconds: int = LISTING_MAX_AGE_SECONDS):
+        with self.connection:
+            self.connection.execute("DELETE FROM market_listings WHERE listing_time < ?",
+                                    (int(datetime.datetime.utcnow().timestamp()) - max_age_seconds,))
 
     def get_last_listing_id(self) -> int:
         cursor = self.connection.cursor()
@@ -64,32 +145,249 @@ class Database:
         return pd.read_sql_query("SELECT * from market_listings", self.connection)
 
     def mark_sold(self, listing_id: int, sold_time: int):
-        cursor = self.connection.cursor()
-        data = cursor.execute(f"SELECT * FROM market_listings WHERE listing_id = {listing_id}").fetchall()
-        if len(data) == 1:
-            cursor.execute(f"INSERT OR IGNORE INTO market_sold VALUES("
-                           f"{data[0][0]},"
-                           f"{data[0][1]},"
-                           f"'{data[0][2]}',"
-                           f"{data[0][3]},"
-                           f"{data[0][4]},"
-                           f"{data[0][5]},"
-                           f"{sold_time - data[0][5]}"
-                           f")")
-        cursor.execute(f"DELETE FROM market_listings WHERE listing_id = {listing_id}")
-        self.connection.commit()
-        pass
+        self.mark_sold_many([listing_id], sold_time)
 
-    def get_sold_prices(self, item_id: int, stat_name: str, stat_amount: float, stat_amount_range: float = 0.2) -> pd.DataFrame:
-        cursor = self.connection.cursor()
-        df = pd.read_sql_query(f"SELECT * FROM market_sold "
-                              f"WHERE item_id = {item_id} "
-                              f"AND off_stat = '{stat_name}' "
-                              f"AND off_stat_amount > {stat_amount * (1 - stat_amount_range)} "
-                              f"AND off_stat_amount < {stat_amount * (1 + stat_amount_range)}", self.connection)
-        return df
+    def mark_sold_many(self, listing_ids: Iterable[int], sold_time: int):
+        """
+        Moves the given listings to market_sold in one transaction.
+        """
+        ids = [int(listing_id) for listing_id in listing_ids]
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO market_sold "
+                                        "SELECT listing_id, item_id, off_stat, off_stat_amount, price, listing_time, "
+                                        "? - listing_time FROM market_listings WHERE listing_id = ?",
+                                        [(int(sold_time), listing_id) for listing_id in ids])
+            self.connection.executemany("DELETE FROM market_listings WHERE listing_id = ?",
+                                        [(listing_id,) for listing_id in ids])
+
+    def get_sold_counts(self, since: int) -> Dict[int, int]:
+        """
+        Returns the number of listings sold per item since the given unix time.
+        """
+        data = self.connection.execute("SELECT item_id, COUNT(*) FROM market_sold "
+                                       "WHERE listing_time + listing_duration_seconds >= ? GROUP BY item_id",
+                                       (since,)).fetchall()
+        return {item_id: count for item_id, count in data}
+
+    def get_sold_price_summary(self, item_id: int, stat_name: str, stat_amount: float,
+                               stat_amount_range: float = 0.2) -> Optional[Dict[str, float]]:
+        """
+        Returns count, min, max, mean, std and median of the sold prices of an item with a bonus stat close
+        to `stat_amount`, from both the raw sold listings and the daily rollups. None if there are no sales.
+        """
+        low = stat_amount * (1 - stat_amount_range)
+        high = stat_amount * (1 + stat_amount_range)
+        prices = [row[0] for row in self.connection.execute(
+            "SELECT price FROM market_sold WHERE item_id = ? AND off_stat = ? "
+            "AND off_stat_amount > ? AND off_stat_amount < ?", (item_id, stat_name, low, high))]
+        rollups = self.connection.execute(
+            "SELECT count, price_sum, price_sum_sq, price_min, price_max, sketch FROM market_sold_daily "
+            "WHERE item_id = ? AND off_stat = ? AND amount_bucket > ? AND amount_bucket < ?",
+            (item_id, stat_name, low * self.AMOUNT_BUCKETS_PER_UNIT, high * self.AMOUNT_BUCKETS_PER_UNIT)).fetchall()
+
+        sketch = PriceSketch()
+        for price in prices:
+            sketch.add(price)
+        count = len(prices)
+        price_sum = float(sum(prices))
+        price_sum_sq = float(sum(price * price for price in prices))
+        price_min = min(prices, default=None)
+        price_max = max(prices, default=None)
+        for r_count, r_sum, r_sum_sq, r_min, r_max, r_sketch in rollups:
+            count += r_count
+            price_sum += r_sum
+            price_sum_sq += r_sum_sq
+            price_min = r_min if price_min is None else min(price_min, r_min)
+            price_max = r_max if price_max is None else max(price_max, r_max)
+            sketch.merge(PriceSketch.from_json(r_sketch))
+        if count == 0:
+            return None
+
+        mean = price_sum / count
+        return {
+            "count": count,
+            "min": price_min,
+            "max": price_max,
+            "mean": mean,
+            "std": math.sqrt(max(0., price_sum_sq / count - mean * mean)),
+            "median": sketch.quantile(0.5),
+        }
+
+    def compact_sold(self, raw_retention_seconds: int):
+        """
+        Rolls the market_sold rows listed more than `raw_retention_seconds` ago into rows of market_sold_daily per
+        item, bonus stat, stat amount bucket and day of sale, and deletes them, in one transaction.
+        """
+        before = int(datetime.datetime.utcnow().timestamp()) - raw_retention_seconds
+        rows = self.connection.execute(
+            "SELECT listing_id, item_id, off_stat, off_stat_amount, price, listing_time + listing_duration_seconds "
+            "FROM market_sold WHERE listing_time < ?", (before,)).fetchall()
+        if len(rows) == 0:
+            return
+
+        groups: Dict[Tuple[int, str, int, int], list] = {}
+        for _, item_id, off_stat, off_stat_amount, price, sold_time in rows:
+            amount_bucket = round((off_stat_amount or 0) * self.AMOUNT_BUCKETS_PER_UNIT)
+            key = (item_id, off_stat or "", amount_bucket, sold_time - sold_time % (24 * 3600))
+            groups.setdefault(key, []).append(price)
+
+        with self.connection:
+            for key, prices in groups.items():
+                existing = self.connection.execute(
+                    "SELECT count, price_sum, price_sum_sq, price_min, price_max, sketch FROM market_sold_daily "
+                    "WHERE item_id = ? AND off_stat = ? AND amount_bucket = ? AND day = ?", key).fetchone()
+                count, price_sum, price_sum_sq, price_min, price_max, sketch = \
+                    existing if existing else (0, 0, 0., min(prices), max(prices), None)
+                sketch = PriceSketch.from_json(sketch)
+                for price in prices:
+                    sketch.add(price)
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO market_sold_daily VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    key + (count + len(prices), price_sum + sum(prices),
+                           price_sum_sq + float(sum(price * price for price in prices)),
+                           min(price_min, min(prices)), max(price_max, max(prices)), sketch.to_json()))
+            self.connection.executemany("DELETE FROM market_sold WHERE listing_id = ?", [(row[0],) for row in rows])
 
     def delete_all_market_listings(self):
         cursor = self.connection.cursor()
         cursor.execute(f"DELETE FROM market_listings")
-        self.connection.commit()
\ No newline at end of file
+        self.connection.commit()
+
+    def insert_sales(self, sales: pd.DataFrame):
+        rows = list(zip(sales["SaleId"].astype("int64").tolist(),
+                        sales["ItemDesignId"].astype("int64").tolist(),
+                        sales["Quantity"].astype("int64").tolist(),
+                        sales["CurrencyType"].astype(str).tolist(),
+                        sales["CurrencyValue"].astype("int64").tolist(),
+                        _to_timestamps(sales["StatusDate"]).tolist()))
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO sales VALUES(?, ?, ?, ?, ?, ?)", rows)
+
+    def get_newest_sale(self, item_id: int) -> Tuple[int, int]:
+        """
+        Returns the id and time of the newest stored sale of an item, zeros if there are none.
+        """
+        data = self.connection.execute("SELECT sale_id, status_time FROM sales WHERE item_id = ? "
+                                       "ORDER BY sale_id DESC LIMIT 1", (item_id,)).fetchone()
+        return (data[0], data[1]) if data else (0, 0)
+
+    def count_sales(self, item_id: int, since: int) -> int:
+        data = self.connection.execute("SELECT COUNT(*) FROM sales WHERE item_id = ? AND status_time >= ?",
+                                       (item_id, since)).fetchone()
+        return data[0]
+
+    def get_sales_coverage(self, item_id: int) -> Optional[int]:
+        """
+        Returns the time from which the stored sales of an item are known to be complete up to the newest one.
+        """
+        data = self.connection.execute("SELECT oldest_time FROM sales_coverage WHERE item_id = ?",
+                                       (item_id,)).fetchone()
+        return data[0] if data else None
+
+    def set_sales_coverage(self, item_id: int, oldest_time: int):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO sales_coverage VALUES(?, ?)", (item_id, oldest_time))
+
+    def get_sales(self, item_id: int, since: int, max_count: int) -> pd.DataFrame:
+        """
+        Returns the stored sales of an item newer than `since`, newest first, in the format of
+        PSSApi.get_sales_for_design_id.
+        """
+        df = pd.read_sql_query("SELECT sale_id AS SaleId, item_id AS ItemDesignId, status_time AS StatusDate, "
+                               "quantity AS Quantity, currency_type AS CurrencyType, currency_value AS CurrencyValue "
+                               "FROM sales WHERE item_id = ? AND status_time >= ? "
+                               "ORDER BY sale_id DESC LIMIT ?", self.connection, params=(item_id, since, max_count))
+        df["StatusDate"] = pd.to_datetime(df["StatusDate"], unit="s")
+        df["SinglePrice"] = df["CurrencyValue"] / df["Quantity"]
+        return df
+
+
+class AsyncDatabase:
+    """
+    Asyncio facade of Database that keeps SQLite off the event loop.
+
+    All writes run on a single writer thread, reads run on a small pool of reader threads. Every thread has
+    its own connection, and WAL journaling lets the readers work while the writer commits.
+    """
+
+    def __init__(self, data_path: str, readers: int = 2):
+        self._data_path = data_path
+        self._local = threading.local()
+        Database(data_path).close()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+
+    def _call(self, method: str, *args, **kwargs):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = Database(self._data_path, create_tables=False)
+        return getattr(db, method)(*args, **kwargs)
+
+    async def _write(self, method: str, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, functools.partial(self._call, method, *args, **kwargs))
+
+    async def _read(self, method: str, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, functools.partial(self._call, method, *args, **kwargs))
+
+    async def insert_market_listings(self, rows: Iterable[ListingRow]):
+        await self._write("insert_market_listings", list(rows))
+
+    async def prune_listings(self, max_age_seconds: int = LISTING_MAX_AGE_SECONDS):
+        await self._write("prune_listings", max_age_seconds)
+
+    async def mark_sold_many(self, listing_ids: Iterable[int], sold_time: int):
+        await self._write("mark_sold_many", list(listing_ids), sold_time)
+
+    async def compact_sold(self, raw_retention_seconds: int):
+        await self._write("compact_sold", raw_retention_seconds)
+
+    async def delete_all_market_listings(self):
+        await self._write("delete_all_market_listings")
+
+    async def insert_sales(self, sales: pd.DataFrame):
+        await self._write("insert_sales", sales)
+
+    async def set_sales_coverage(self, item_id: int, oldest_time: int):
+        await self._write("set_sales_coverage", item_id, oldest_time)
+
+    async def get_last_listing_id(self) -> int:
+        return await self._read("get_last_listing_id")
+
+    async def get_listings(self) -> pd.DataFrame:
+        return await self._read("get_listings")
+
+    async def get_sold_counts(self, since: int) -> Dict[int, int]:
+        return await self._read("get_sold_counts", since)
+
+    async def get_sold_price_summary(self, item_id: int, stat_name: str, stat_amount: float,
+                                     stat_amount_range: float = 0.2) -> Optional[Dict[str, float]]:
+        return await self._read("get_sold_price_summary", item_id, stat_name, stat_amount, stat_amount_range)
+
+    async def get_newest_sale(self, item_id: int) -> Tuple[int, int]:
+        return await self._read("get_newest_sale", item_id)
+
+    async def count_sales(self, item_id: int, since: int) -> int:
+        return await self._read("count_sales", item_id, since)
+
+    async def get_sales_coverage(self, item_id: int) -> Optional[int]:
+        return await self._read("get_sales_coverage", item_id)
+
+    async def get_sales(self, item_id: int, since: int, max_count: int) -> pd.DataFrame:
+        return await self._read("get_sales", item_id, since, max_count)
+
+
+def to_timestamp(date) -> int:
+    """
+    Converts a naive UTC date to a unix timestamp the same way the stored sales are.
+    """
+    return int((pd.Timestamp(date) - pd.Timestamp(0)) // pd.Timedelta(seconds=1))
+
+
+def _to_timestamps(dates: pd.Series) -> pd.Series:
+    return (pd.to_datetime(dates) - pd.Timestamp(0)) // pd.Timedelta(seconds=1)
@@ -0,0 +1,44 @@
+import asyncio
+import logging as log
+from typing import Dict, Optional
+from characters import Characters
+from items import Items
+from pss_api import PSSApi
+
+
+class DesignRefresher:
+    """
+    Keeps the item and character designs up to date. The design version numbers of the latest settings are
+    checked every `interval_seconds` and a catalog is fetched again only when its version has changed, or when
+    the version it was fetched at is not known.
+    """
+    VERSION_KEYS = {
+        "items": "ItemDesignVersion",
+        "characters": "CharacterDesignVersion",
+    }
+
+    def __init__(self, api: PSSApi, items: Items, characters: Characters, interval_seconds: float = 300):
+        self._api = api
+        self._catalogs = {"items": items, "characters": characters}
+        self._interval_seconds = interval_seconds
+
+    async def check(self):
+        versions: Optional[Dict[str, int]] = await self._api.get_design_versions()
+        if versions is None:
+            log.warning("Failed to get the design versions")
+            return
+        for name, catalog in self._catalogs.items():
+            version = versions.get(self.VERSION_KEYS[name])
+            if version is None or version == catalog.design_version:
+                continue
+            log.info(f"Design version of {name} changed from {catalog.design_version} to {version}")
+            try:
+                if not await catalog.refresh(version):
+                    log.error(f"Failed to fetch the {name} designs")
+            except Exception as e:
+                log.error(f"Failed to refresh the {name} designs: {e}")
+
+    async def run(self):
+        while True:
+            await self.check()
+            await asyncio.sleep(self._interval_seconds)
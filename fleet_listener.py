@@ -1,29 +1,31 @@
-from typing import List, Optional
+from typing import Dict, List, Optional
 from items import Items
-from pss_api import PSSApi
+from pss_api import DonatedCrew, PSSApi
 from characters import Characters
+from state_store import StateStore
+from xml_columns import ROW
 import re
 from telegram_bot import TelegramBot
 import time
 import logging as log
 import asyncio
 import os
-import cloudpickle as pickle
+import numpy as np
 import pandas as pd
 import datetime
 
 class FleetListener:
-    def __init__(self, api: PSSApi, characters: Characters, items: Items, data_path: str):
+    def __init__(self, api: PSSApi, characters: Characters, items: Items, state: StateStore):
         self._interest_crew = {}
         self._api = api
         self._characters = characters
         self._items = items
         self._last_sale_id: int = 0
         self._telegram: Optional[TelegramBot] = None
-        self._data_path = data_path
+        self._state = state
         self._alliance_id: Optional[int] = self._load_alliance_id()
         self._load_interest_crew()
-        self._crew_df: Optional[pd.DataFrame] = None
+        self._crew: Optional[DonatedCrew] = None
         self._telegram: Optional[TelegramBot] = None
 
     def remove_interest_crew(self, stat: str):
@@ -42,32 +44,18 @@ class FleetListener:
         self.store_interest_crew()
 
     def store_interest_crew(self):
-        filename = os.path.join(
-            self._data_path, "fleet", "interest_crew.pickle")
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        with open(filename, "wb") as outfile:
-            pickle.dump(self._interest_crew, outfile)
+        self._state.set("interest_crew", self._interest_crew)
 
     def _load_interest_crew(self):
-        filename = os.path.join(
-            self._data_path, "fleet", "interest_crew.pickle")
-        if os.path.exists(filename):
-            with open(filename, "rb") as infile:
-                self._interest_crew = pickle.load(infile)
+        self._state.migrate_pickle("interest_crew", os.path.join("fleet", "interest_crew.pickle"))
+        self._interest_crew = self._state.get("interest_crew", {})
 
     def _store_alliance_id(self):
-        filename = os.path.join(self._data_path, "fleet", "alliance_id.pickle")
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        with open(filename, "wb") as outfile:
-            pickle.dump(self._alliance_id, outfile)
+        self._state.set("alliance_id", self._alliance_id)
 
     def _load_alliance_id(self) -> Optional[int]:
-        filename = os.path.join(
-            self._data_path, "fleet", "alliance_id.pickle")
-        if os.path.exists(filename):
-            with open(filename, "rb") as infile:
-                return pickle.load(infile)
-        return None
+        self._state.migrate_pickle("alliance_id", os.path.join("fleet", "alliance_id.pickle"))
+        return self._state.get("alliance_id")
 
     async def set_fleet(self, name: str) -> bool:
         all = await self._api.get_alliances()
@@ -79,37 +67,56 @@ class FleetListener:
         else:
             return False
 
-    async def _do_check(self, df: Optional[pd.DataFrame]):
-        if df is None:
-            df = await self._api.get_available_donated_crew_for_fleet(self._alliance_id)
-        if df is not None and len(df) > 0:
-            for index, row in df.iterrows():
-                id = row.CharacterDesignId
-                level = row.Level
-                name = row.CharacterName
-                for stat, value in self._interest_crew.items():
-                    crew_stat_value = self._characters.get_stat_at_level(character_id=id, level=level, stat=stat)
-                    improvement = row[f"{stat}Improvement"]
-                    crew_stat_value = crew_stat_value * ((100 + improvement) / 100)
-                    if isinstance(row.ItemDesignIDs, str):
-                        ids = row.ItemDesignIDs.split(',')
-                        for item_id in ids:
-                            item_id = int(item_id)
-                            enc_type, enc_value = self._items.get_enhancement(item_id)
-                            if enc_type == stat:
-                                crew_stat_value += enc_value
-                        bonus_stats = row.ItemBonusStats.split(',')
-                        bonus_vals = row.ItemBonusVals.split(',')
-                        index = 0
-                        for bonus_stat in bonus_stats:
-                            if bonus_stat == stat:
-                                crew_stat_value += float(bonus_vals[index])
-                            index += 1
-                    if crew_stat_value > value:
-                        yield f'<i>crew available</i> - <b>{name}</b> - <b>{row.OwnerUsername}</b> - {stat} {int(crew_stat_value)}'
+    def _get_equipment(self, crew: DonatedCrew) -> pd.DataFrame:
+        """
+        Returns the equipped items of the crew in long form: one row per item with the crew row position,
+        ItemDesignId, bonus stat and value and the item's own enhancement.
+        """
+        items = crew.items
+        equipment = pd.DataFrame({
+            "Crew": items.get(ROW, 0),
+            "ItemDesignId": items.get("ItemDesignId", 0),
+            "BonusStat": items.get("BonusEnhancementType"),
+            "BonusValue": items.get("BonusEnhancementValue", 0.),
+        })
+        equipment["BonusValue"] = pd.to_numeric(equipment["BonusValue"], errors="coerce").fillna(0.)
+        return equipment.join(self._items.get_enhancements(), on="ItemDesignId")
+
+    def _evaluate(self, crew: DonatedCrew, interest_crew: Dict[str, float]) -> List[str]:
+        """
+        Computes the final value of every watched stat for all crew at once and returns the alert messages
+        for the crew above the watched values.
+        """
+        crew_count = len(crew.crew)
+        equipment = self._get_equipment(crew)
+        wearer = equipment["Crew"].to_numpy(dtype="int64")
+
+        stats = list(interest_crew.keys())
+        values = np.zeros((crew_count, len(stats)))
+        for column, stat in enumerate(stats):
+            base = self._characters.stats_at_levels(crew.crew["CharacterDesignId"], crew.crew["Level"], stat)
+            improvement_column = f"{stat}Improvement"
+            improvement = crew.crew[improvement_column].astype(float) if improvement_column in crew.crew else 0.
+            enhancement = np.where(equipment["EnhancementType"] == stat, equipment["EnhancementValue"], 0.)
+            bonus = np.where(equipment["BonusStat"] == stat, equipment["BonusValue"], 0.)
+            values[:, column] = base * ((100 + improvement) / 100) + \
+                np.bincount(wearer, weights=enhancement + bonus, minlength=crew_count)
+
+        matches = values > np.array([interest_crew[stat] for stat in stats])
+        names = crew.crew["CharacterName"]
+        owners = crew.crew["OwnerUsername"]
+        return [f'<i>crew available</i> - <b>{names[row]}</b> - <b>{owners[row]}</b> - {stats[column]} {int(values[row, column])}'
+                for row, column in np.argwhere(matches)]
+
+    async def _do_check(self, crew: Optional[DonatedCrew]):
+        if crew is None:
+            crew = await self._api.get_available_donated_crew_for_fleet(self._alliance_id)
+        if crew is not None and len(crew.crew) > 0:
+            for message in self._evaluate(crew, self._interest_crew.copy()):
+                yield message
 
     async def get_current_messages(self) -> str:
-        async for message in self._do_check(self._crew_df):
+        async for message in self._do_check(self._crew):
             yield message
 
     async def run(self):
@@ -119,15 +126,17 @@ class FleetListener:
                 await asyncio.sleep(2)
                 continue
 
-            df = await self._api.get_available_donated_crew_for_fleet(self._alliance_id)
-            if self._crew_df is not None:
-                merged = self._crew_df.merge(df, how="right", indicator=True)
-                new = merged[merged["_merge"] == "right_only"]
+            crew = await self._api.get_available_donated_crew_for_fleet(self._alliance_id)
+            if crew is None:
+                await asyncio.sleep(5)
+                continue
+            if self._crew is not None and len(self._crew.crew) > 0 and len(crew.crew) > 0:
+                new = crew.take(np.flatnonzero(~np.isin(crew.crew["CharacterId"], self._crew.crew["CharacterId"])))
             else:
-                new = df
+                new = crew
 
             async for message in self._do_check(new):
                 await self._telegram.send_message(message)
-            self._crew_df = df
+            self._crew = crew
 
             await asyncio.sleep(5)
\ No newline at end of file
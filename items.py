@@ -1,7 +1,57 @@
-from typing import Optional
+from typing import Any, Dict, NamedTuple, Optional
 from pss_api import PSSApi
-import cloudpickle as pickle
+from catalog_store import CatalogStore, load_or_fetch
+import asyncio
+import logging as log
 import os
+import pandas as pd
+
+
+class ItemRecord(NamedTuple):
+    design_id: int
+    name: str
+    rarity: str
+    subtype: str
+    enhancement_type: str
+    enhancement_value: float
+    market_price: Optional[int]
+    can_have_substats: bool
+
+
+class ItemIndex:
+    """
+    Item designs indexed by ItemDesignId and ItemDesignName, built once from the item design frame.
+    """
+    SUBSTAT_RARITIES = ("Hero", "Special", "Legendary")
+
+    def __init__(self, items: pd.DataFrame, price_corrections: Dict[str, int]):
+        self.by_id: Dict[int, ItemRecord] = {}
+        self.ids_by_name: Dict[str, int] = {}
+        columns = zip(items["ItemDesignId"], items["ItemDesignName"], items["Rarity"], items["ItemSubType"],
+                      items["EnhancementType"], items["EnhancementValue"], items["MarketPrice"])
+        for design_id, name, rarity, subtype, enhancement_type, enhancement_value, market_price in columns:
+            design_id = int(design_id)
+            if design_id in self.by_id:
+                continue
+            rarity = str(rarity)
+            subtype = str(subtype)
+            market_price = price_corrections.get(name, None if pd.isna(market_price) else int(market_price))
+            self.by_id[design_id] = ItemRecord(
+                design_id=design_id,
+                name=name,
+                rarity=rarity,
+                subtype=subtype,
+                enhancement_type=str(enhancement_type),
+                enhancement_value=float(enhancement_value),
+                market_price=market_price,
+                can_have_substats="Equipment" in subtype and rarity in self.SUBSTAT_RARITIES)
+            self.ids_by_name.setdefault(name, design_id)
+
+        enhanced = [item for item in self.by_id.values() if 'None' not in item.enhancement_type]
+        self.enhancements = pd.DataFrame({
+            "EnhancementType": [item.enhancement_type for item in enhanced],
+            "EnhancementValue": [item.enhancement_value for item in enhanced],
+        }, index=pd.Index([item.design_id for item in enhanced], name="ItemDesignId"))
 
 
 class Items:
@@ -13,85 +63,96 @@ class Items:
     }
 
     def __init__(self, data_path, api: PSSApi):
-        self._filename = os.path.join(data_path, "items", f"df")
+        self._legacy_filename = os.path.join(data_path, "items", f"df")
+        self._catalog = CatalogStore(os.path.join(data_path, "items", "catalog"))
         self._api = api
-        self._items: Optional[Items] = None
-    
+        self._items: Optional[pd.DataFrame] = None
+        self._index: Optional[ItemIndex] = None
+        self._design_version: Optional[int] = None
+
+    @property
+    def is_cached(self) -> bool:
+        """
+        Whether setup() can load the designs from disk instead of the API.
+        """
+        return self._catalog.exists() or os.path.exists(self._legacy_filename)
+
     async def setup(self):
-        if os.path.exists(self._filename):
-            with open(self._filename, "rb") as infile:
-                self._items = pickle.load(infile)
-        else:
-            self._items = await self._api.get_items()
-            os.makedirs(os.path.dirname(self._filename), exist_ok=True)
-            with open(self._filename, "wb") as outfile:
-                pickle.dump(self._items, outfile)
+        self._items = await load_or_fetch(self._catalog, self._api.get_items, self._legacy_filename,
+                                          fetch_metadata=self._fetch_metadata)
+        self._index = ItemIndex(self._items, self.PRICE_CORRECTIONS)
+        self._design_version = self._catalog.metadata.get("design_version")
+
+    async def _fetch_metadata(self) -> Dict[str, Any]:
+        """
+        Catalog metadata for a fresh fetch: the current item design version, so that the refresher does not
+        fetch the same designs again.
+        """
+        version = await self._api.get_design_version("ItemDesignVersion")
+        return {"design_version": version} if version is not None else {}
+
+    @property
+    def design_version(self) -> Optional[int]:
+        """
+        ItemDesignVersion of the loaded designs, None if it is not known.
+        """
+        return self._design_version
+
+    async def refresh(self, design_version: int) -> bool:
+        """
+        Fetches the item designs again and swaps in the new index at once, so that lookups keep using the
+        previous one until then.
+        """
+        items = await self._api.get_items()
+        if items is None or len(items) == 0:
+            return False
+        loop = asyncio.get_running_loop()
+        index = await loop.run_in_executor(None, ItemIndex, items, self.PRICE_CORRECTIONS)
+        await loop.run_in_executor(None, self._catalog.save, items, {"design_version": design_version})
+        added = [item.name for design_id, item in index.by_id.items() if design_id not in self._index.by_id]
+        log.info(f"Item designs updated to version {design_version}, new items: {', '.join(added) or 'none'}")
+        self._items, self._index = items, index
+        self._design_version = design_version
+        return True
+
+    def get_item(self, design_id: int) -> Optional[ItemRecord]:
+        return self._index.by_id.get(design_id)
+
+    def get_enhancements(self) -> pd.DataFrame:
+        """
+        Returns the EnhancementType and EnhancementValue of every item with an enhancement, indexed by ItemDesignId.
+        """
+        return self._index.enhancements
 
     def get_design_id_by_name(self, name: str) -> Optional[int]:
-        try:
-            return int(self._items[self._items["ItemDesignName"] == name].iloc[0]['ItemDesignId'])
-        except:
-            return None
+        return self._index.ids_by_name.get(name)
 
     def get_name_by_design_id(self, design_id: int) -> Optional[str]:
-        try:
-            return self._items[self._items["ItemDesignId"] == design_id].iloc[0]['ItemDesignName']
-        except:
-            return None
+        item = self.get_item(design_id)
+        return item.name if item else None
 
     def get_market_price(self, design_id: int) -> Optional[int]:
-        name = self.get_name_by_design_id(design_id)
-        if name is None:
-            return None
-        else:
-            if name in self.PRICE_CORRECTIONS:
-                return self.PRICE_CORRECTIONS[name]
-            else:
-                try:
-                    return self._items[self._items["ItemDesignId"] == design_id].iloc[0]["MarketPrice"]
-                except:
-                    return None
-    
+        item = self.get_item(design_id)
+        return item.market_price if item else None
+
     def get_rarity(self, design_id: int) -> Optional[str]:
-        name = self.get_name_by_design_id(design_id)
-        if name is None:
-            return None
-        else:
-            try:
-                return self._items[self._items["ItemDesignId"] == design_id].iloc[0]["Rarity"]
-            except:
-                return None
-    
+        item = self.get_item(design_id)
+        return item.rarity if item else None
+
     def get_subtype(self, design_id: int) -> Optional[str]:
-        name = self.get_name_by_design_id(design_id)
-        if name is None:
-            return None
-        else:
-            try:
-                return self._items[self._items["ItemDesignId"] == design_id].iloc[0]["ItemSubType"]
-            except:
-                return None
-    
+        item = self.get_item(design_id)
+        return item.subtype if item else None
+
     def get_main_stat(self, design_id: int):
-        name = self.get_name_by_design_id(design_id)
-        if name is None:
-            return None
-        else:
-            try:
-                return self._items[self._items["ItemDesignId"] == design_id].iloc[0]["EnhancementType"]
-            except:
-                return None
-
-    def item_can_have_substats(self, design_id: int) -> Optional[str]:
-        rarity = self.get_rarity(design_id)
-        subtype = self.get_subtype(design_id)
-        return "Equipment" in subtype and rarity in ("Hero", "Special", "Legendary")
+        item = self.get_item(design_id)
+        return item.enhancement_type if item else None
+
+    def item_can_have_substats(self, design_id: int) -> bool:
+        item = self.get_item(design_id)
+        return item.can_have_substats if item else False
 
     def get_enhancement(self, design_id: int) -> (Optional[str], Optional[float]):
-        row = self._items[self._items["ItemDesignId"] == design_id].iloc[0]
-        type = row.EnhancementType
-        if 'None' in type:
+        item = self.get_item(design_id)
+        if item is None or 'None' in item.enhancement_type:
             return None, None
-        else:
-            value = float(row.EnhancementValue)
-        return type, value
\ No newline at end of file
+        return item.enhancement_type, item.enhancement_value
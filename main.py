@@ -1,18 +1,21 @@
 import datetime
-from typing import Optional
+from typing import Awaitable, Callable, List, Optional
 from pss_api import PSSApi
 from market_listener import MarketListener
 from items import Items
 from characters import Characters
+from design_refresher import DesignRefresher
 from fleet_listener import FleetListener
-from db import Database
+from db import AsyncDatabase
+from sales_history import SalesHistory
+from sold_listener import SoldListener
+from state_store import StateStore
 import time
 import re
 import telegram_bot
 import asyncio
 import json
 import pandas as pd
-import cloudpickle as pickle
 import os
 import logging
 
@@ -23,7 +26,7 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def consumables(api: PSSApi):
+async def consumables(sales: SalesHistory):
     output = {
         "item": [],
         "price": [],
@@ -104,16 +107,7 @@ def consumables(api: PSSApi):
     }
 
     for id in design_ids:
-        df: pd.DataFrame = None
-        filename = os.path.join("data", "market", f"{id}")
-        if os.path.exists(filename):
-            with open(filename, "rb") as infile:
-                df = pickle.load(infile)
-        else:
-            df = api.get_sales_for_design_id(id, past_days=7)
-            os.makedirs(os.path.dirname(filename), exist_ok=True)
-            with open(filename, "wb") as outfile:
-                pickle.dump(df, outfile)
+        df = await sales.get_sales_for_design_id(id, past_days=7)
         try:
             count = len(df)
         except TypeError as e:
@@ -139,37 +133,83 @@ def consumables(api: PSSApi):
     pass
 
 
+async def run_when_ready(ready: List[asyncio.Task], run: Callable[[], Awaitable]):
+    """
+    Starts a listener once the setup steps it depends on have finished.
+    """
+    await asyncio.gather(*ready)
+    await run()
+
+
+async def timed_setup(name: str, setup: Awaitable, started: float, cached: bool):
+    await setup
+    logger.info(f"{name} ready in {time.monotonic() - started:.2f} s ({'warm' if cached else 'cold'} start)")
+
+
 async def main():
+    started = time.monotonic()
     data_path = "/data"
     if not os.path.exists(data_path):
         data_path = "data"
 
-    db = Database(data_path)
+    with open (os.path.join(data_path, "config.json")) as f:
+        config = json.load(f)
+
+    db = AsyncDatabase(data_path)
+    state = StateStore(data_path)
 
     #db.delete_all_market_listings()
-    api = PSSApi(data_path)
-    await api.setup()
+    api = PSSApi(state, device_count=config.get("api_devices", 1))
     items = Items(data_path, api)
-    await items.setup()
-    market = MarketListener(api, items, db, data_path)
-
     characters = Characters(data_path, api)
-    await characters.setup()
+    cold = not items.is_cached or not characters.is_cached
 
-    fleet = FleetListener(api, characters, items, data_path)
+    ip_probe = asyncio.create_task(api.log_external_ip())
+    api_ready = asyncio.create_task(api.setup())
 
-    with open (os.path.join(data_path, "config.json")) as f:
-        config = json.load(f)
+    async def setup_items():
+        if not items.is_cached:
+            # the item designs are queried with an access token of the device
+            await api_ready
+        await items.setup()
+
+    items_ready = asyncio.create_task(timed_setup("Items", setup_items(), started, items.is_cached))
+    characters_ready = asyncio.create_task(
+        timed_setup("Characters", characters.setup(), started, characters.is_cached))
+
+    sales = SalesHistory(api, db)
+    market = MarketListener(api, items, db, sales, state)
+    fleet = FleetListener(api, characters, items, state)
+
+    sold = SoldListener(api, items, db, sales, budget_share=config.get("sold_check_budget_share", 0.25),
+                        raw_retention_days=config.get("sold_raw_retention_days", 30))
+
+    refresher = DesignRefresher(api, items, characters,
+                                interval_seconds=config.get("design_refresh_interval_seconds", 300))
 
     bot = telegram_bot.TelegramBot(config["telegram"], market, items, fleet, db)
     market.set_telegram(bot)
     fleet.set_telegram(bot)
 
-    await asyncio.gather(
-        market.run(),
-        market.run_trader_check(),
-        bot.run(),
-        fleet.run())
+    async def report_startup():
+        await asyncio.gather(api_ready, items_ready, characters_ready)
+        logger.info(f"Startup finished in {time.monotonic() - started:.2f} s ({'cold' if cold else 'warm'} start)")
+
+    try:
+        await asyncio.gather(
+            report_startup(),
+            run_when_ready([api_ready, items_ready], market.run),
+            run_when_ready([api_ready, items_ready], market.run_trader_check),
+            run_when_ready([api_ready, items_ready], sold.run),
+            # the fleet and market commands need the characters and the API as well
+            run_when_ready([api_ready, items_ready, characters_ready], bot.run),
+            run_when_ready([api_ready, items_ready, characters_ready], fleet.run),
+            run_when_ready([api_ready, items_ready, characters_ready], refresher.run))
+    finally:
+        ip_probe.cancel()
+        await api.close()
+        db.close()
+        state.close()
 
 
 if __name__ == "__main__":
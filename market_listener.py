@@ -1,40 +1,71 @@
-from typing import List, Optional
+from typing import Iterator, List, Optional
 from items import Items
 from pss_api import PSSApi
-from db import Database
-import re
+from db import AsyncDatabase
+from state_store import StateStore
+from sales_history import SalesHistory
+from pipeline import StageStats, StageTimer, log_stage_stats, put_with_backpressure
+from xml_columns import Columns
 from telegram_bot import TelegramBot
 import time
 import logging as log
 import asyncio
 import os
-import cloudpickle as pickle
 import pandas as pd
 import datetime
 
 
+def parse_market_messages(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Parses the Argument, ActivityArgument and Message columns of a market message frame at once and returns a
+    copy with added design_id, count, currency, amount (per unit), stat_name and stat_amount columns.
+    Messages without a bonus stat get None/NaN stat columns. Messages without a valid item, count or price
+    are logged and left out, so that they do not cost the rest of the batch.
+    """
+    arguments = df["Argument"].astype(object).str.extract(r":(\d+)x(\d+)")
+    activity = df["ActivityArgument"].astype(object).str.extract(r"^([^:]*):(\d+)")
+    valid = arguments.notna().all(axis=1) & activity.notna().all(axis=1) & (arguments[1] != "0")
+    if not valid.all():
+        log.error(f"Skipping unparsable market messages: {df.loc[~valid, 'SaleId'].tolist()}")
+        df, arguments, activity = df[valid], arguments[valid], activity[valid]
+    df = df.copy()
+    df["design_id"] = arguments[0].astype("int64")
+    df["count"] = arguments[1].astype("int64")
+    df["currency"] = activity[0]
+    df["amount"] = activity[1].astype("int64") // df["count"]
+
+    # "(+5.5 Hp)": the first number in the first token is the amount, the second token the stat name
+    stat = df["Message"].astype(object).str.extract(r"\(\D*?(\d*\.*\d+)\S*\s+([^)\s]+)\)")
+    stat_amount = pd.to_numeric(stat[0], errors="coerce")
+    has_stat = stat_amount.notna() & stat[1].notna()
+    df["stat_amount"] = stat_amount.where(has_stat)
+    df["stat_name"] = stat[1].astype(object).where(has_stat, None)
+    return df
+
+
 class MarketMessage:
-    def __init__(self, row: pd.Series):
-        self.message_id = row["MessageId"]
-        self.message = row["Message"]
-        arguments = row["Argument"].split("x")
-        self.design_id = int(arguments[0].split(":")[1])
-        self.count = int(arguments[1])
-        self.sale_id = row["SaleId"]
-        self.currency = row["ActivityArgument"].split(":")[0]
-        self.amount = int(int(row["ActivityArgument"].split(":")[1]) / self.count)
-        self.date = row["MessageDate"].to_pydatetime()
-        if "(" in self.message:
-            stat_val = re.search("\(.*\)", self.message).group().split(" ")
-            try:
-                self.stat_amount = float(re.findall(r'(?:\d*\.*\d+)', stat_val[0])[0])
-                self.stat_name = stat_val[1][:-1]
-            except IndexError:
-                self.stat_amount = None
-                self.stat_name = None
-        else:
-            self.stat_amount = None
-            self.stat_name = None
+    """
+    A single market message from a frame returned by parse_market_messages.
+    """
+    __slots__ = ("message_id", "message", "design_id", "count", "sale_id", "currency", "amount", "date",
+                 "stat_amount", "stat_name")
+
+    def __init__(self, row):
+        self.message_id = row.MessageId
+        self.message = row.Message
+        self.design_id = int(row.design_id)
+        self.count = int(row.count)
+        self.sale_id = row.SaleId
+        self.currency = row.currency
+        self.amount = int(row.amount)
+        self.date = row.MessageDate.to_pydatetime()
+        self.stat_amount = None if pd.isna(row.stat_amount) else float(row.stat_amount)
+        self.stat_name = row.stat_name
+
+    @staticmethod
+    def from_frame(df: pd.DataFrame) -> Iterator["MarketMessage"]:
+        for row in df.itertuples(index=False):
+            yield MarketMessage(row)
 
 class BonusStatImportance:
     HIGH = 1.0
@@ -114,18 +145,25 @@ class MarketListener:
         "Repair": "RPR",
     }
 
-    def __init__(self, api: PSSApi, items: Items, db: Database, data_path: str):
+    POLL_INTERVAL_SECONDS = 2
+    QUEUE_SIZE = 10
+    NOTIFY_QUEUE_SIZE = 100
+    STAGE_STATS_INTERVAL_SECONDS = 15 * 60
+    LISTING_PRUNE_INTERVAL_SECONDS = 10 * 60
+
+    def __init__(self, api: PSSApi, items: Items, db: AsyncDatabase, sales: SalesHistory, state: StateStore):
         self._interest_items = {}
         self._trader_items = []
         self._api = api
+        self._sales = sales
         self._items: Items = items
-        self._db: Database = db
+        self._db: AsyncDatabase = db
         self._last_sale_id: int = 0
         self._telegram: Optional[TelegramBot] = None
-        self._data_path = data_path
+        self._state = state
         self._load_interest_items()
         self._load_trader_items()
-        self._next_sold_check: Optional[datetime.datetime] = None
+        self._next_listing_prune: float = 0
 
     def set_telegram(self, telegram: TelegramBot):
         self._telegram = telegram
@@ -145,11 +183,6 @@ class MarketListener:
                 if stat not in self.STAT_MAX:
                     raise Exception(f"Uknown stat {stat} for {name}, possible options: {self.STAT_MAX.keys()}!")
             design_id = self._items.get_design_id_by_name(name)
-
-            sales = await self._api.get_sales_for_design_id(design_id, past_days=10, max_count=50)
-            mean = sales["SinglePrice"].mean()
-            std = sales["SinglePrice"].std()
-            mean_price = sales[(sales["SinglePrice"] > mean - std) & (sales["SinglePrice"] < mean + std)].mean(numeric_only=True)["SinglePrice"]
             self._interest_items[design_id] = {"stats": stats}
             await self.update_interest_item_price(design_id)
             self.store_interest_items()
@@ -166,16 +199,11 @@ class MarketListener:
             log.error(e)
 
     def store_trader_items(self):
-        filename = os.path.join(self._data_path, "market", "trader_items.pickle")
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        with open(filename, "wb") as outfile:
-            pickle.dump(self._trader_items, outfile)
+        self._state.set("trader_items", self._trader_items)
     
     def _load_trader_items(self):
-        filename = os.path.join(self._data_path, "market", "trader_items.pickle")
-        if os.path.exists(filename):
-            with open(filename, "rb") as infile:
-                self._trader_items = pickle.load(infile)
+        self._state.migrate_pickle("trader_items", os.path.join("market", "trader_items.pickle"))
+        self._trader_items = self._state.get("trader_items", [])
     
     def remove_trader_item(self, name: str):
         design_id = self._items.get_design_id_by_name(name)
@@ -190,7 +218,7 @@ class MarketListener:
         item = self._interest_items[design_id]
         now = datetime.datetime.now()
         if "last_price_update" not in item or now - item["last_price_update"] > datetime.timedelta(hours=1):
-            sales = await self._api.get_sales_for_design_id(design_id, past_days=10)
+            sales = await self._sales.get_sales_for_design_id(design_id, past_days=10)
             mean = sales["SinglePrice"].mean()
             std = sales["SinglePrice"].std()
             mean_price = sales[(sales["SinglePrice"] > mean - std) & (sales["SinglePrice"] < mean + std)].mean(numeric_only=True)["SinglePrice"]
@@ -207,143 +235,197 @@ class MarketListener:
             return False
 
     def store_interest_items(self):
-        filename = os.path.join(self._data_path, "market", "interest_items.pickle")
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        with open(filename, "wb") as outfile:
-            pickle.dump(self._interest_items, outfile)
+        self._state.set("interest_items", self._interest_items)
 
     def _load_interest_items(self):
-        filename = os.path.join(self._data_path, "market", "interest_items.pickle")
-        if os.path.exists(filename):
-            with open(filename, "rb") as infile:
-                self._interest_items = pickle.load(infile)
-
-    async def _monitor_sold(self, df_new_listings: pd.DataFrame):
-        last_id = self._db.get_last_listing_id()
-        for index, row in df_new_listings.iterrows():
-            msg = MarketMessage(row)
-            if msg.sale_id > last_id:
-                if self._items.item_can_have_substats(msg.design_id):
-                    self._db.insert_market_listing(msg.sale_id, msg.design_id, msg.stat_name, msg.stat_amount,
-                                                   int(msg.amount / msg.count), msg.date)
-
-        if self._next_sold_check is not None:
-            if datetime.datetime.now() < self._next_sold_check:
-                return
-        self._next_sold_check = datetime.datetime.now() + datetime.timedelta(minutes=5)
-
-        listings = self._db.get_listings()
-        for item_id in pd.unique(listings["item_id"]):
-            sales = await self._api.get_sales_for_design_id(item_id, past_days=1, max_count=20, max_queries=1)
-            if sales is None:
-                log.error(f"Failed to get sales for {self._items.get_name_by_design_id(item_id)}!")
-                continue
-            listings_for_item = listings[listings["item_id"] == item_id]
-            for index, row in listings_for_item.iterrows():
-                sales_for_listing = sales[sales["SaleId"] == row["listing_id"]]
-                if len(sales_for_listing) > 0:
-                    sold_time = int(sales_for_listing["StatusDate"].iloc[0].to_pydatetime().timestamp())
-                    self._db.mark_sold(row["listing_id"], int(datetime.datetime.utcnow().timestamp()))
+        self._state.migrate_pickle("interest_items", os.path.join("market", "interest_items.pickle"))
+        self._interest_items = self._state.get("interest_items", {})
+
+    async def _record_listings(self, df_new_listings: pd.DataFrame):
+        last_id = await self._db.get_last_listing_id()
+        df_new_listings = df_new_listings[df_new_listings["SaleId"] > last_id]
+        with_substats = [self._items.item_can_have_substats(design_id) for design_id in df_new_listings["design_id"]]
+        await self._db.insert_market_listings([
+            (msg.sale_id, msg.design_id, msg.stat_name, msg.stat_amount, int(msg.amount / msg.count), msg.date)
+            for msg in MarketMessage.from_frame(df_new_listings[with_substats])])
+
+        now = time.monotonic()
+        if now >= self._next_listing_prune:
+            self._next_listing_prune = now + self.LISTING_PRUNE_INTERVAL_SECONDS
+            await self._db.prune_listings()
+
+    def _take_new_messages(self, columns: Columns) -> Columns:
+        """
+        Returns the messages listed after the last seen sale and advances the SaleId high-water mark.
+        """
+        if len(columns) == 0:
+            return columns
+        new = columns.take(columns["SaleId"] > self._last_sale_id)
+        if len(new) > 0:
+            self._last_sale_id = int(new["SaleId"].max())
+        return new
+
+    async def _evaluate_message(self, msg: MarketMessage, interest_items: dict) -> Optional[str]:
+        """
+        Returns the alert message for a new listing of an interest item, None if it is not interesting.
+        """
+        interesting = False
+        vals = interest_items[msg.design_id]
+        can_have_substats = self._items.item_can_have_substats(msg.design_id)
+        if can_have_substats:
+            for stat in vals["stats"]:
+                if msg.stat_name is not None and stat in msg.stat_name:
+                    interesting = True
+        else:
+            interesting = True
+
+        if interesting:
+            await self.update_interest_item_price(msg.design_id)
+            market_price = interest_items[msg.design_id]["mean_price"]
+            if can_have_substats:
+                importance = BonusStatImportance.get_importance(self._items.get_main_stat(msg.design_id), msg.stat_name)
+                if importance < 0:
+                    ok_price = market_price * (1 + importance)
+                    cheap_price = ok_price * 0.9
+                else:
+                    stat_percentage = 1 + msg.stat_amount / self.STAT_MAX[msg.stat_name]
+
+                    cheap_price = market_price + \
+                                importance * \
+                                (market_price / 2 * stat_percentage + \
+                                market_price / 6 * pow(stat_percentage, 2))
+                    ok_price = market_price + \
+                            importance * \
+                            (market_price * stat_percentage + \
+                            market_price * pow(stat_percentage, 2))
+            else:
+                cheap_price = market_price * 0.9
+                ok_price = market_price * 1.1
+            icon = ""
+            if msg.currency == "starbux":
+                bux = True
+                if msg.amount < cheap_price:
+                    icon = '\U0001F7E2'
+                    price_comment = "Cheap"
+                elif msg.amount < ok_price:
+                    icon = '\U0001F7E1'
+                    price_comment = "OK"
+                else:
+                    icon = '\U0001F534'
+                    price_comment = "Expensive"
+            else:
+                bux = False
+                price_comment = "Cheap"
+                icon = '\U0001F7E2'
+
+            #if can_have_substats or (not can_have_substats and price_comment != "Expensive"):
+            if price_comment != "Expensive" or True:
+                name = self._items.get_name_by_design_id(msg.design_id)
+                message = f'{icon} <b>{name}</b> - '
+                if can_have_substats:
+                    message += f'{msg.stat_amount} {self.STAT_SHORT[msg.stat_name]} - '
+                    message += f'cheap {int(cheap_price)} - ok {int(ok_price)} - '
+                message += f'{msg.amount} '
+                if not bux:
+                    message += f'{msg.currency} '
+                message += f'- <a href="https://pixyship.com/item/{msg.design_id}">pixyship</a>'
+                log.info(message)
+                return message
+        return None
 
     async def run(self):
+        """
+        Runs the market ingestion as a pipeline of stages connected by bounded queues:
+        fetch -> parse -> record listings / evaluate interest items -> notify.
+        A slow stage fills its input queue and only then makes the previous stage wait.
+        """
+        raw = asyncio.Queue(maxsize=self.QUEUE_SIZE)
+        to_record = asyncio.Queue(maxsize=self.QUEUE_SIZE)
+        to_evaluate = asyncio.Queue(maxsize=self.QUEUE_SIZE)
+        to_notify = asyncio.Queue(maxsize=self.NOTIFY_QUEUE_SIZE)
+        stats = {
+            "fetch": StageStats("fetch"),
+            "parse": StageStats("parse", raw),
+            "record": StageStats("record", to_record),
+            "evaluate": StageStats("evaluate", to_evaluate),
+            "notify": StageStats("notify", to_notify),
+        }
+        await asyncio.gather(
+            self._fetch_stage(raw, stats["fetch"]),
+            self._parse_stage(raw, (to_record, to_evaluate), stats["parse"]),
+            self._record_stage(to_record, stats["record"]),
+            self._evaluate_stage(to_evaluate, to_notify, stats["evaluate"]),
+            self._notify_stage(to_notify, stats["notify"]),
+            log_stage_stats(stats, self.STAGE_STATS_INTERVAL_SECONDS))
+
+    async def _fetch_stage(self, outbox: asyncio.Queue, stats: StageStats):
         first = True
-        df_prev: Optional[pd.DataFrame] = None
         while True:
-            interest_items = self._interest_items.copy()
-
-            if first:
-                count = 999999
+            started = time.monotonic()
+            with StageTimer(stats):
+                if first:
+                    count = 999999
+                else:
+                    count = 20
+                columns = await self._api.get_market_messages(design_id=None, count=count)
+            if columns is not None:
                 first = False
-            else:
-                count = 20
+                new = self._take_new_messages(columns)
+                if len(new) > 0:
+                    await put_with_backpressure(outbox, new.to_frame(), "parse")
+            await asyncio.sleep(max(0., self.POLL_INTERVAL_SECONDS - (time.monotonic() - started)))
 
-            df = await self._api.get_market_messages(design_id=None, count=count)
-            if df is None:
+    async def _parse_stage(self, inbox: asyncio.Queue, outboxes, stats: StageStats):
+        while True:
+            df = await inbox.get()
+            try:
+                with StageTimer(stats):
+                    df = parse_market_messages(df)
+            except Exception as e:
+                log.error(f"Failed to parse market messages: {e}")
                 continue
-            if df_prev is not None:
-                merged = df_prev.merge(df, how="right", indicator=True)
-                new = merged[merged["_merge"] == "right_only"]
-            else:
-                new = df
-            df_prev = df
+            if len(df) == 0:
+                continue
+            for outbox in outboxes:
+                await put_with_backpressure(outbox, df, "record/evaluate")
 
-            if len(new) > 0:
-                await self._monitor_sold(new)
+    async def _record_stage(self, inbox: asyncio.Queue, stats: StageStats):
+        while True:
+            df = await inbox.get()
+            try:
+                with StageTimer(stats):
+                    await self._record_listings(df)
+            except Exception as e:
+                log.error(f"Failed to record market listings: {e}")
 
+    async def _evaluate_stage(self, inbox: asyncio.Queue, outbox: asyncio.Queue, stats: StageStats):
+        while True:
+            df = await inbox.get()
+            interest_items = self._interest_items.copy()
             if len(interest_items) == 0:
-                await asyncio.sleep(2)
                 continue
+            with StageTimer(stats):
+                messages = []
+                for msg in MarketMessage.from_frame(df[df["design_id"].isin(list(interest_items))]):
+                    try:
+                        message = await self._evaluate_message(msg, interest_items)
+                    except Exception as e:
+                        log.error(f"Failed to evaluate listing {msg.sale_id}: {e}")
+                        continue
+                    if message is not None:
+                        messages.append(message)
+            for message in messages:
+                await put_with_backpressure(outbox, message, "notify")
+
+    async def _notify_stage(self, inbox: asyncio.Queue, stats: StageStats):
+        while True:
+            message = await inbox.get()
+            with StageTimer(stats):
+                try:
+                    await self._telegram.send_message(message, html=True)
+                except Exception as e:
+                    log.error(f"Failed to send market alert: {e}")
 
-            if df is not None:
-                df = df[df["SaleId"] > self._last_sale_id]
-                for index, row in df.iterrows():
-                    msg = MarketMessage(row)
-                    if msg.design_id in interest_items:
-                        interesting = False
-                        vals = interest_items[msg.design_id]
-                        can_have_substats = self._items.item_can_have_substats(msg.design_id)
-                        if can_have_substats:
-                            for stat in vals["stats"]:
-                                if stat in msg.stat_name:
-                                    interesting = True
-                        else:
-                            interesting = True
-
-                        if interesting:
-                            await self.update_interest_item_price(msg.design_id)
-                            market_price = interest_items[msg.design_id]["mean_price"]
-                            if can_have_substats:
-                                importance = BonusStatImportance.get_importance(self._items.get_main_stat(msg.design_id), msg.stat_name)
-                                if importance < 0:
-                                    ok_price = market_price * (1 + importance)
-                                    cheap_price = ok_price * 0.9
-                                else:
-                                    stat_percentage = 1 + msg.stat_amount / self.STAT_MAX[msg.stat_name]
-                                    
-                                    cheap_price = market_price + \
-                                                importance * \
-                                                (market_price / 2 * stat_percentage + \
-                                                market_price / 6 * pow(stat_percentage, 2))
-                                    ok_price = market_price + \
-                                            importance * \
-                                            (market_price * stat_percentage + \
-                                            market_price * pow(stat_percentage, 2))
-                            else:
-                                cheap_price = market_price * 0.9
-                                ok_price = market_price * 1.1
-                            icon = ""
-                            if msg.currency == "starbux":
-                                bux = True
-                                if msg.amount < cheap_price:
-                                    icon = '\U0001F7E2'
-                                    price_comment = "Cheap"
-                                elif msg.amount < ok_price:
-                                    icon = '\U0001F7E1'
-                                    price_comment = "OK"
-                                else:
-                                    icon = '\U0001F534'
-                                    price_comment = "Expensive"
-                            else:
-                                bux = False
-                                price_comment = "Cheap"
-                                icon = '\U0001F7E2'
-
-                            #if can_have_substats or (not can_have_substats and price_comment != "Expensive"):
-                            if price_comment != "Expensive" or True:
-                                name = self._items.get_name_by_design_id(msg.design_id)
-                                message = f'{icon} <b>{name}</b> - '
-                                if can_have_substats:
-                                    message += f'{msg.stat_amount} {self.STAT_SHORT[msg.stat_name]} - '
-                                    message += f'cheap {int(cheap_price)} - ok {int(ok_price)} - '
-                                message += f'{msg.amount} '
-                                if not bux:
-                                    message += f'{msg.currency} '
-                                message += f'- <a href="https://pixyship.com/item/{msg.design_id}">pixyship</a>'
-                                await self._telegram.send_message(message, html=True)
-                                log.info(message)
-                    self._last_sale_id = max(self._last_sale_id, msg.sale_id)
-            await asyncio.sleep(2)
-    
     async def run_trader_check(self):
         while True:
             df = await self._api.get_star_system_markers()
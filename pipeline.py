@@ -0,0 +1,65 @@
+import asyncio
+import logging as log
+import time
+from typing import Dict, Optional
+
+
+class StageStats:
+    """
+    Processing time of one pipeline stage since the last report.
+    """
+
+    def __init__(self, name: str, queue: Optional[asyncio.Queue] = None):
+        self.name = name
+        self._queue = queue
+        self._count = 0
+        self._total = 0.0
+        self._max = 0.0
+
+    def record(self, seconds: float):
+        self._count += 1
+        self._total += seconds
+        self._max = max(self._max, seconds)
+
+    def report(self) -> str:
+        mean = self._total / self._count if self._count else 0.0
+        text = f"{self.name}: {self._count} runs, mean {mean * 1000:.1f} ms, max {self._max * 1000:.1f} ms"
+        if self._queue is not None:
+            text += f", queued {self._queue.qsize()}/{self._queue.maxsize}"
+        self._count = 0
+        self._total = 0.0
+        self._max = 0.0
+        return text
+
+
+class StageTimer:
+    """
+    Context manager recording the time spent inside it to a StageStats.
+    """
+
+    def __init__(self, stats: StageStats):
+        self._stats = stats
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self._stats.record(time.perf_counter() - self._start)
+
+
+async def put_with_backpressure(queue: asyncio.Queue, item, stage: str):
+    """
+    Puts an item to a bounded queue, logging when the consumer is behind and the producer has to wait.
+    """
+    if queue.full():
+        log.warning(f"Pipeline stage {stage} is behind, waiting for space in its queue")
+    await queue.put(item)
+
+
+async def log_stage_stats(stats: Dict[str, StageStats], interval_seconds: float):
+    while True:
+        await asyncio.sleep(interval_seconds)
+        for stage in stats.values():
+            log.info(f"Pipeline {stage.report()}")
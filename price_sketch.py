@@ -0,0 +1,49 @@
+import json
+import math
+from typing import Dict, Optional
+
+
+class PriceSketch:
+    """
+    Mergeable quantile sketch of prices: a histogram with logarithmic buckets, so every quantile is estimated
+    within RELATIVE_ACCURACY of the true value.
+    """
+    RELATIVE_ACCURACY = 0.02
+    _GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+    _LOG_GAMMA = math.log(_GAMMA)
+
+    def __init__(self, buckets: Optional[Dict[int, int]] = None):
+        self.buckets: Dict[int, int] = buckets or {}
+
+    @property
+    def count(self) -> int:
+        return sum(self.buckets.values())
+
+    def add(self, price: float, count: int = 1):
+        index = math.ceil(math.log(max(price, 1)) / self._LOG_GAMMA)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def merge(self, other: "PriceSketch"):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def quantile(self, q: float) -> Optional[float]:
+        total = self.count
+        if total == 0:
+            return None
+        rank = q * (total - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return 2 * self._GAMMA ** index / (self._GAMMA + 1)
+        return None
+
+    def to_json(self) -> str:
+        return json.dumps(self.buckets, separators=(",", ":"))
+
+    @staticmethod
+    def from_json(text: Optional[str]) -> "PriceSketch":
+        if not text:
+            return PriceSketch()
+        return PriceSketch({int(index): count for index, count in json.loads(text).items()})
@@ -1,174 +1,339 @@
-import os
-from typing import Optional
-from pss_login import Device, _create_device_key
-import cloudpickle as pickle
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, NamedTuple, Optional
+from pss_login import Device, DevicePool, LoginError, _create_device_key
+from state_store import StateStore
+import settings
+from xml_columns import ROW, Columns, parse_columns, parse_nested_columns
 import asyncio
+import aiohttp
+import numpy as np
 import pandas as pd
-import requests
 import logging as log
-import time
+
+
+class DonatedCrew(NamedTuple):
+    """
+    Crew donated to a fleet and their equipped items, one row per item. The ROW column of `items` is the
+    position of the wearer in `crew`.
+    """
+    crew: Columns
+    items: Columns
+
+    def take(self, rows: np.ndarray) -> "DonatedCrew":
+        """
+        Returns the crew at the given positions with their items.
+        """
+        rows = np.asarray(rows, dtype="int64")
+        if len(self.items) == 0:
+            return DonatedCrew(self.crew.take(rows), self.items)
+        position = np.full(len(self.crew), -1)
+        position[rows] = np.arange(len(rows))
+        item_position = position[self.items[ROW]]
+        kept = item_position >= 0
+        return DonatedCrew(self.crew.take(rows), self.items.take(kept).with_column(ROW, item_position[kept]))
+
+
+class SalesCrawl(NamedTuple):
+    """
+    Result of PSSApi.crawl_sales_for_design_id: the Starbux sales, whether the crawl is complete and how many
+    pages were queried.
+    """
+    sales: Optional[pd.DataFrame]
+    complete: bool
+    queries: int
 
 
 class PSSApi:
     BASE_URL = "https://api.pixelstarships.com/"
-
-    def __init__(self, data_path):
-        self._data_path = data_path
-        self._last_query = 0
-        self._queries = 0
-        self._last_query_rate_check = 0
+    REQUEST_TIMEOUT_SECONDS = 30
+    MAX_CONNECTIONS = 10
+    KEEPALIVE_SECONDS = 60
+    MAX_THROTTLED_RETRIES = 3
+    SALES_PAGE_SIZE = 100
+    SALES_CONCURRENT_PAGES = 3
+
+    def __init__(self, state: StateStore, device_count: int = 1):
+        self._state = state
+        self._device_count = device_count
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._devices = DevicePool(self._create_device, on_change=self._store_devices)
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+
+    @property
+    def limiter(self) -> DevicePool:
+        """
+        The device pool, whose rate and queue_depth are the combined ones of the devices.
+        """
+        return self._devices
 
     async def setup(self):
-        self._dev = await self._get_device()
-        response = requests.get('http://ifconfig.me')
-        log.info(f"External IP address: {response.text}")
-
-    async def _get_token(self, get_new=False):
-        return await self._dev.get_access_token()
-
-    async def _get_device(self, get_new=False) -> Optional[Device]:
-        filename = os.path.join(self._data_path, "device.pickle")
-        dev = None
-        if not get_new and os.path.exists(filename):
-            with open(filename, "rb") as infile:
-                data = pickle.load(infile)
-                log.info(f"Creating device with {data}")
-                dev = Device(
-                    device_key=data[0], can_login_until=data[1], access_token=data[2], last_login=data[3])
+        for device in self._load_devices():
+            self._devices.add(device)
+        self._store_devices(self._devices.devices)
+
+    async def log_external_ip(self):
+        """
+        Logs the external IP address. Only informational, so startup does not wait for it.
+        """
+        text = await self._get_url('http://ifconfig.me', {})
+        log.info(f"External IP address: {text}")
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """
+        Returns the shared HTTP session, creating it on first use. All requests go through the same
+        connection pool so that connections to the API are kept alive between queries.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.MAX_CONNECTIONS, keepalive_timeout=self.KEEPALIVE_SECONDS)
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=aiohttp.ClientTimeout(total=self.REQUEST_TIMEOUT_SECONDS))
+        return self._session
+
+    async def close(self):
+        self._devices.close()
+        self._store_devices(self._devices.devices)
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _get_url(self, url: str, params: dict, timeout: Optional[float] = None) -> Optional[str]:
+        # passing timeout=None would disable the session timeout, so it is only passed to override it
+        options = {"timeout": aiohttp.ClientTimeout(total=timeout)} if timeout else {}
+        try:
+            async with self._get_session().get(url, params=params, **options) as response:
+                return await response.text(encoding="utf-8")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.error(f"Request to {url} failed: {e!r}")
+            return None
+
+    async def _get(self, path: str, params: dict, timeout: Optional[float] = None, authorized: bool = False) -> Optional[str]:
+        """
+        Queries the PSS API through the least loaded device of the pool, adding its access token to the
+        parameters of `authorized` queries. "Too many" responses lower the rate of the device and the query is
+        retried up to MAX_THROTTLED_RETRIES times, after that the last response is returned.
+        """
+        url = self.BASE_URL + path.lstrip("/")
+        text = None
+        try:
+            for _ in range(self.MAX_THROTTLED_RETRIES + 1):
+                async with self._devices.use(authorized) as (limiter, token):
+                    query = dict(params, accessToken=token) if authorized else params
+                    text = await self._get_url(url, query, timeout=timeout)
+                    if text is None:
+                        return None
+                    if "Too many" not in text:
+                        limiter.on_success()
+                        return text
+                    log.info(f"Got too many response from {path}, {self._devices.queue_depth} queries waiting")
+                    limiter.on_throttled()
+        except LoginError as e:
+            log.error(f"Cannot query {path}: {e}")
+            return None
+        return text
+
+    async def _single_flight(self, path: str, params: dict,
+                             fetch: Callable[[str, dict], Awaitable[Any]]) -> Any:
+        """
+        Runs `fetch(path, params)` unless the same query is in flight already, in which case the caller shares
+        its parsed result. Results are shared as they are, so they must not be modified by the callers.
+        Cancelling one caller does not cancel the query for the others.
+        """
+        key = (path, tuple(sorted(params.items())))
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fetch(path, params))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
         else:
-            dev = Device(_create_device_key())
-            token = await dev.get_access_token()
-            with open(filename, "wb") as outfile:
-                data = (dev.key, dev.can_login_until, token, dev.last_login)
-                pickle.dump(data, outfile)
-
-        return dev
+            log.debug(f"Joining the query in flight to {path} with {params}")
+        return await asyncio.shield(task)
+
+    def _create_device(self) -> Device:
+        return Device(_create_device_key(), get_session=self._get_session)
+
+    def _load_devices(self) -> List[Device]:
+        """
+        Returns the stored devices, adding new ones up to the configured device count. New devices log in
+        when their token refresher starts.
+        """
+        self._state.migrate_pickle("device", "device.pickle")
+        stored = self._state.get("devices")
+        if stored is None:
+            device = self._state.get("device")
+            stored = [device] if device is not None else []
+            self._state.delete("device")
+        devices = [Device(device_key=data[0], can_login_until=data[1], access_token=data[2], last_login=data[3],
+                          get_session=self._get_session)
+                   for data in stored[:self._device_count]]
+        while len(devices) < self._device_count:
+            devices.append(self._create_device())
+        log.info(f"Using {len(devices)} devices: {', '.join(device.key for device in devices)}")
+        return devices
+
+    def _store_devices(self, devices: List[Device]):
+        self._state.set("devices", [(device.key, device.can_login_until, device.access_token, device.last_login)
+                                    for device in devices])
 
     async def _check_if_token_expired_from_response(self, response: str):
         if "Failed to authorize" in response:
-            self.token = await self._get_token(get_new=True)
+            log.warning("Access token was not accepted")
+
+    async def get_design_versions(self) -> Optional[Dict[str, int]]:
+        """
+        Returns the design version numbers of the latest settings, such as ItemDesignVersion and
+        CharacterDesignVersion. They change whenever the corresponding designs are updated.
+        """
+        return await self._single_flight(settings.LATEST_SETTINGS_BASE_PATH + "en", {}, self._fetch_design_versions)
+
+    async def get_design_version(self, name: str) -> Optional[int]:
+        """
+        Returns one design version number, e.g. ItemDesignVersion, None if it cannot be queried.
+        """
+        versions = await self.get_design_versions()
+        return versions.get(name) if versions is not None else None
+
+    async def _fetch_design_versions(self, path: str, params: dict) -> Optional[Dict[str, int]]:
+        text = await self._get(path, params)
+        if text is None:
+            return None
+        try:
+            columns = parse_columns(text, "SettingService", "Setting")
+        except Exception as e:
+            log.error(f"Failed to parse the latest settings: {e}")
+            return None
+        if len(columns) == 0:
+            return None
+        return {name: int(columns[name][0]) for name in columns.names if name.endswith("DesignVersion")}
 
     async def get_items(self, _token=None) -> pd.DataFrame:
-        await self._throttle_queries()
         df: pd.DataFrame = None
-        params = {
-            'accessToken': await self._get_token(),
-        }
-        try:
-            response = requests.get(
-                self.BASE_URL + "ItemService/ListItemDesigns2", params=params)
-        except Exception as e:
+        params = {}
+        text = await self._get("ItemService/ListItemDesigns2", params, authorized=True)
+        if text is None:
             return df
 
         try:
             df = pd.read_xml(
-                response.text, xpath="/ItemService/ListItemDesigns/ItemDesigns//ItemDesign")
+                text, xpath="/ItemService/ListItemDesigns/ItemDesigns//ItemDesign")
         except Exception as e:
-            await self._check_if_token_expired_from_response(response.text)
-            print(f"ERROR: {e}: {response.text}")
+            await self._check_if_token_expired_from_response(text)
+            print(f"ERROR: {e}: {text}")
 
         return df
 
     async def get_characters(self, _token=None) -> pd.DataFrame:
-        await self._throttle_queries()
         df: pd.DataFrame = None
-        params = {
-        }
-        try:
-            response = requests.get(
-                self.BASE_URL + "CharacterService/ListAllCharacterDesigns2", params=params)
-        except Exception as e:
+        params = {}
+        text = await self._get("CharacterService/ListAllCharacterDesigns2", params)
+        if text is None:
             return df
 
         try:
-            df = pd.read_xml(
-                response.text, xpath="/CharacterService/ListAllCharacterDesigns/CharacterDesigns//CharacterDesign")
+            df = parse_columns(text, "CharacterDesigns", "CharacterDesign").to_frame()
         except Exception as e:
-            await self._check_if_token_expired_from_response(response.text)
-            print(f"ERROR: {e}: {response.text}")
+            await self._check_if_token_expired_from_response(text)
+            print(f"ERROR: {e}: {text}")
 
         return df
 
     async def get_star_system_markers(self, _token=None) -> pd.DataFrame:
-        await self._throttle_queries()
         log.debug(f"Getting star system markers")
         df: pd.DataFrame = None
-        params = {
-            'accessToken': await self._get_token(),
-        }
-        try:
-            response = requests.get(
-                self.BASE_URL + "GalaxyService/ListStarSystemMarkers", params=params)
-        except Exception as e:
+        params = {}
+        text = await self._get("GalaxyService/ListStarSystemMarkers", params, authorized=True)
+        if text is None:
             return df
 
         try:
-            df = pd.read_xml(response.text, xpath="/GalaxyService/ListStarSystemMarkers/StarSystemMarkers//StarSystemMarker",
-                             parse_dates=["StarSystemArrivalDate", "ExpiryDate", "TravelStartDate", "LastUpdateDate"])
+            df = parse_columns(text, "StarSystemMarkers", "StarSystemMarker",
+                               dates=["StarSystemArrivalDate", "ExpiryDate", "TravelStartDate", "LastUpdateDate"]).to_frame()
         except Exception as e:
-            print(f"ERROR: {e}: {response.text}")
+            print(f"ERROR: {e}: {text}")
 
         return df
 
-    async def get_sales_for_design_id(self, design_id: int, past_days=2, max_count=100, max_queries=100) -> pd.DataFrame:
-        start = 0
-        end = max_count
-
-        df: pd.DataFrame = None
-        queries = 0
-        while True:
-            await self._throttle_queries()
-            params = {
-                'itemDesignId': design_id,
-                'saleStatus': 'Sold',
-                'from': start,
-                'to': end,
-                'accessToken': await self._get_token(),
-            }
-            response = requests.get(
-                self.BASE_URL + "/MarketService/ListSalesByItemDesignId", params=params)
-            try:
-                df_new = pd.read_xml(response.text, xpath="/MarketService/ListSalesByItemDesignId/Sales//Sale",
-                                     parse_dates=["StatusDate"])
-            except Exception as e:
-                if "Too many" in response.text:
-                    log.info(
-                        f"Got too many response while getting sales for {design_id}")
-                    await asyncio.sleep(10)
-                    continue
-                await self._check_if_token_expired_from_response(response.text)
-                log.error(f"ERROR: {response.text}")
-                return df
-
-            queries += 1
-
-            len_all = len(df_new)
-            df_new = df_new[df_new["CurrencyType"] == "Starbux"]
-            df_new["SinglePrice"] = df_new["CurrencyValue"] / \
-                df_new["Quantity"]
-            if len_all > 0:
-                if df is None:
-                    df = df_new
-                else:
-                    df = pd.concat([df, df_new], ignore_index=True)
-            else:
-                break
-            start += 20
-            end += 20
-            if pd.Timestamp.now() - df["StatusDate"].min() > pd.Timedelta(days=past_days):
-                break
-            if len(df) >= max_count:
-                break
-            if queries >= max_queries:
-                break
-        return df
+    async def _get_sales_page(self, design_id: int, start: int, end: int) -> Optional[Columns]:
+        params = {
+            'itemDesignId': design_id,
+            'saleStatus': 'Sold',
+            'from': start,
+            'to': end,
+        }
+        return await self._single_flight("MarketService/ListSalesByItemDesignId", params, self._fetch_sales_page)
 
-    async def get_market_messages(self, design_id: Optional[int], count=999999) -> pd.DataFrame:
-        await self._throttle_queries()
+    async def _fetch_sales_page(self, path: str, params: dict) -> Optional[Columns]:
+        text = await self._get(path, params, authorized=True)
+        if text is None:
+            return None
+        try:
+            return parse_columns(text, "Sales", "Sale", dates=["StatusDate"])
+        except Exception as e:
+            await self._check_if_token_expired_from_response(text)
+            log.error(f"ERROR: {text}")
+            return None
 
+    async def get_sales_for_design_id(self, design_id: int, past_days=2, max_count=100, max_queries=100) -> pd.DataFrame:
+        """
+        Returns the latest Starbux sales of an item, newest first, until `max_count` sales, `max_queries` pages
+        or a sale older than `past_days` is reached.
+        """
+        crawl = await self.crawl_sales_for_design_id(design_id, past_days=past_days, max_count=max_count,
+                                                     max_queries=max_queries)
+        return crawl.sales
+
+    async def crawl_sales_for_design_id(self, design_id: int, past_days=2, max_count=100, max_queries=100,
+                                        newer_than_sale_id: int = 0) -> SalesCrawl:
+        """
+        Crawls the sales of an item, newest first. The first page is fetched alone, the following ones
+        SALES_CONCURRENT_PAGES at a time. Crawling stops at the first sale older than `past_days`, at a sale
+        not newer than `newer_than_sale_id`, at the end of the history or when `max_count` Starbux sales or
+        `max_queries` pages are reached.
+
+        Returns the Starbux sales, whether the crawl is complete, i.e. it did not stop on one of the limits
+        or an error, and the number of pages queried.
+        """
+        page_size = min(max_count, self.SALES_PAGE_SIZE)
+        cutoff = (pd.Timestamp.now() - pd.Timedelta(days=past_days)).to_datetime64()
+
+        pages: List[Columns] = []
+        starbux_count = 0
+        queries = 0
+        complete = False
+        done = False
+        while not done and queries < max_queries:
+            batch = 1 if queries == 0 else min(self.SALES_CONCURRENT_PAGES, max_queries - queries)
+            results = await asyncio.gather(*[
+                self._get_sales_page(design_id, (queries + i) * page_size, (queries + i + 1) * page_size)
+                for i in range(batch)])
+            queries += batch
+            for page in results:
+                done = True
+                if page is None:
+                    break
+                if len(page) == 0:
+                    complete = True
+                    break
+                pages.append(page)
+                starbux_count += int((page["CurrencyType"] == "Starbux").sum())
+                if page["StatusDate"].min() < cutoff or page["SaleId"].min() <= newer_than_sale_id:
+                    complete = True
+                    break
+                if starbux_count >= max_count:
+                    break
+                done = False
+
+        if len(pages) == 0:
+            return SalesCrawl(None, complete, queries)
+        df = pd.concat([page.to_frame() for page in pages], ignore_index=True).drop_duplicates(subset="SaleId")
+        df = df[(df["CurrencyType"] == "Starbux") & (df["SaleId"] > newer_than_sale_id)].reset_index(drop=True)
+        df["SinglePrice"] = df["CurrencyValue"] / df["Quantity"]
+        return SalesCrawl(df, complete, queries)
+
+    async def get_market_messages(self, design_id: Optional[int], count=999999) -> Optional[Columns]:
+        """
+        Returns the active market listings as Columns, callers that need a DataFrame build it with to_frame().
+        """
         log.debug(f"Getting market for id {design_id}")
 
-        df: pd.DataFrame = None
         params = {
             'currencyType': 'Unknown',
             'itemSubType': 'None',
@@ -176,85 +341,64 @@ class PSSApi:
             'userId': 0,
             'skip': 0,
             'take': count,
-            'accessToken': await self._get_token(),
         }
         if design_id:
             params['itemDesignId'] = design_id
         log.debug(params)
-        try:
-            response = requests.get(
-                self.BASE_URL + "/MessageService/ListActiveMarketplaceMessages5", params=params)
-        except Exception as e:
-            print(e)
-            return df
+        return await self._single_flight("MessageService/ListActiveMarketplaceMessages5", params,
+                                         self._fetch_market_messages)
+
+    async def _fetch_market_messages(self, path: str, params: dict) -> Optional[Columns]:
+        columns: Optional[Columns] = None
+        text = await self._get(path, params, authorized=True)
+        if text is None:
+            return columns
 
         try:
-            log.debug(f"RESPONSE {response.text}")
-            df = pd.read_xml(response.text, xpath="/MessageService/ListActiveMarketplaceMessages/Messages//Message",
-                             parse_dates=["MessageDate"])
+            log.debug(f"RESPONSE {text}")
+            columns = parse_columns(text, "Messages", "Message", dates=["MessageDate"])
         except Exception as e:
-            await self._check_if_token_expired_from_response(response.text)
-            if "Too many" in response.text:
-                time.sleep(10)
-        return df
+            await self._check_if_token_expired_from_response(text)
+        return columns
 
-    async def get_available_donated_crew_for_fleet(self, fleet_id: int, count=999999) -> pd.DataFrame:
-        await self._throttle_queries()
+    async def get_available_donated_crew_for_fleet(self, fleet_id: int, count=999999) -> Optional[DonatedCrew]:
         log.debug(f"Getting donated crew for id {fleet_id}")
 
-        df: pd.DataFrame = None
         params = {
             'allianceId': fleet_id,
             'skip': 0,
             'take': count,
-            'accessToken': await self._get_token(),
         }
-        try:
-            response = requests.get(
-                self.BASE_URL + "/AllianceService/ListCharactersGivenInAlliance", params=params)
-        except Exception as e:
-            print(e)
-            return df
+        return await self._single_flight("AllianceService/ListCharactersGivenInAlliance", params,
+                                         self._fetch_donated_crew)
+
+    async def _fetch_donated_crew(self, path: str, params: dict) -> Optional[DonatedCrew]:
+        crew: Optional[DonatedCrew] = None
+        text = await self._get(path, params, authorized=True)
+        if text is None:
+            return crew
 
         try:
-            log.debug(f"RESPONSE {response.text}")
-            df = pd.read_xml(response.text, xpath="/AllianceService/ListCharactersGivenInAlliance/Characters//Character",
-                             stylesheet="fleetitems.xsl",
-                             parse_dates=["TrainingEndDate", "DeploymentDate", "AvailableDate"])
+            log.debug(f"RESPONSE {text}")
+            crew = DonatedCrew(*parse_nested_columns(text, "Characters", "Character", "Item",
+                                                     dates=["TrainingEndDate", "DeploymentDate", "AvailableDate"]))
         except Exception as e:
-            await self._check_if_token_expired_from_response(response.text)
-            if "Too many" in response.text:
-                time.sleep(10)
-        return df
+            await self._check_if_token_expired_from_response(text)
+        return crew
 
     async def get_alliances(self, count=100) -> pd.DataFrame:
-        await self._throttle_queries()
         df: pd.DataFrame = None
         params = {
             'take': count,
         }
-        try:
-            response = requests.get(
-                self.BASE_URL + "/AllianceService/ListAlliancesByRanking", params=params)
-        except Exception as e:
-            print(e)
+        text = await self._get("AllianceService/ListAlliancesByRanking", params)
+        if text is None:
             return df
 
         try:
-            log.debug(f"RESPONSE {response.text}")
-            df = pd.read_xml(response.text, xpath="/AllianceService/ListAlliancesByRanking/Alliances//Alliance",
+            log.debug(f"RESPONSE {text}")
+            df = pd.read_xml(text, xpath="/AllianceService/ListAlliancesByRanking/Alliances//Alliance",
                              parse_dates=["ImmunityDate"])
         except Exception as e:
-            await self._check_if_token_expired_from_response(response.text)
-            if "Too many" in response.text:
-                time.sleep(10)
+            await self._check_if_token_expired_from_response(text)
         return df
-
-    async def _throttle_queries(self):
-        time_between_queries = 0.5
-        if time.time() - self._last_query < time_between_queries:
-            await asyncio.sleep(time_between_queries)
-        else:
-            self._last_query = time.time()
-
-
@@ -1,12 +1,17 @@
 from datetime import datetime, timedelta
+import asyncio
 import hashlib
 import json
 import random
-from typing import List, Optional
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, List, Optional, Tuple
 
 import aiohttp
 from asyncio import Lock
 
+from pipeline import StageStats
+from rate_limiter import AdaptiveRateLimiter
 import settings
 import utils
 
@@ -15,6 +20,10 @@ import logging as log
 # ---------- Constants & Internals ----------
 
 ACCESS_TOKEN_TIMEOUT: timedelta = timedelta(minutes=3)
+ACCESS_TOKEN_REFRESH_MARGIN: timedelta = timedelta(seconds=30)
+LOGIN_RETRY_SECONDS: float = 15
+LOGIN_STATS_INTERVAL_SECONDS: float = 3600
+DEVICE_BENCH_SECONDS: float = 600
 
 DEVICE_LOGIN_PATH: str = 'UserService/DeviceLogin8'
 
@@ -41,8 +50,9 @@ class DeviceInUseError(LoginError):
 # ---------- Classes ----------
 
 class Device():
-    def __init__(self, device_key: str, can_login_until: datetime = None, device_type: str = None, access_token: str = None, last_login: datetime = None) -> None:
+    def __init__(self, device_key: str, can_login_until: datetime = None, device_type: str = None, access_token: str = None, last_login: datetime = None, get_session: Callable[[], aiohttp.ClientSession] = None) -> None:
         self.__key: str = device_key
+        self.__get_session: Optional[Callable[[], aiohttp.ClientSession]] = get_session
         self.__checksum: str = None
         self.__device_type = device_type or DEFAULT_DEVICE_TYPE
         self.__last_login: datetime = last_login
@@ -54,6 +64,8 @@ class Device():
         self.__token_lock: Lock = Lock()
         self.__update_lock: Lock = Lock()
         self.__can_login_until_changed: bool = False
+        self.__refresh_stats: StageStats = StageStats('token refresh')
+        self.__blocking_login_stats: StageStats = StageStats('login on demand')
 
     @property
     def access_token_expired(self) -> bool:
@@ -61,6 +73,10 @@ class Device():
             return self.__access_token_expires_at < utils.get_utc_now()
         return True
 
+    @property
+    def access_token(self) -> Optional[str]:
+        return self.__access_token
+
     @property
     def can_login(self) -> bool:
         if self.__can_login_until is None:
@@ -90,16 +106,62 @@ class Device():
         """
         Returns a valid access token. If there's no valid access token related to this Device, this method will attempt to log in and retrieve an access token via the PSS API.
         """
+        if not self.access_token_expired:
+            # a renewal in progress holds the lock, but the current token is still valid until it completes
+            return self.__access_token
         async with self.__token_lock:
             if self.access_token_expired:
                 log.debug("Access token is expired!")
                 if self.can_login:
                     log.debug("Logging in!")
+                    started = time.monotonic()
                     await self.__login()
+                    self.__blocking_login_stats.record(time.monotonic() - started)
                 else:
                     raise LoginError('Cannot login currently. Please try again later.')
             return self.__access_token
 
+    async def keep_access_token_fresh(self) -> None:
+        """
+        Logs in again ACCESS_TOKEN_REFRESH_MARGIN before the access token expires, so that API calls do not wait for a login. Runs until cancelled or the device turns out to be in use.
+        """
+        next_report = time.monotonic() + LOGIN_STATS_INTERVAL_SECONDS
+        while True:
+            await asyncio.sleep(self.__seconds_until_refresh())
+            try:
+                async with self.__token_lock:
+                    if not self.can_login:
+                        raise LoginError('Cannot login currently.')
+                    started = time.monotonic()
+                    await self.__login()
+                    self.__refresh_stats.record(time.monotonic() - started)
+            except DeviceInUseError as e:
+                log.error(f'Stopped renewing the access token of device {self.__key}: {e}')
+                return
+            except LoginError as e:
+                if self.can_login:
+                    log.error(f'Failed to renew the access token of device {self.__key}: {e}')
+                else:
+                    log.debug(f'Device {self.__key} cannot renew its access token until {self.__can_login_until}')
+                await asyncio.sleep(LOGIN_RETRY_SECONDS)
+            except Exception as e:
+                log.error(f'Failed to renew the access token of device {self.__key}: {e!r}')
+                await asyncio.sleep(LOGIN_RETRY_SECONDS)
+            else:
+                if self.__access_token is None:
+                    log.error(f'Login of device {self.__key} returned no access token')
+                    await asyncio.sleep(LOGIN_RETRY_SECONDS)
+
+            if time.monotonic() >= next_report:
+                next_report = time.monotonic() + LOGIN_STATS_INTERVAL_SECONDS
+                log.info(f'Device {self.__key} {self.__refresh_stats.report()}; {self.__blocking_login_stats.report()}')
+
+    def __seconds_until_refresh(self) -> float:
+        if self.__access_token_expires_at is None:
+            return 0.
+        refresh_at = self.__access_token_expires_at - ACCESS_TOKEN_REFRESH_MARGIN
+        return max(0., (refresh_at - utils.get_utc_now()).total_seconds())
+
 
     async def __login(self) -> None:
         base_url = "https://api.pixelstarships.com/"
@@ -118,14 +180,11 @@ class Device():
         if settings.PRINT_DEBUG_WEB_REQUESTS:
             log.debug(f'[WebRequest] Attempting to get data from url: {url}')
             log.debug(f'[WebRequest]   with parameters: {json.dumps(query_params, separators=(",", ":"))}')
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, params=query_params) as response:
-                data = await response.text(encoding='utf-8')
-                if settings.PRINT_DEBUG_WEB_REQUESTS:
-                    log_data = data or ''
-                    if log_data and len(log_data) > 100:
-                        log_data = log_data[:100]
-                    log.debug(f'[WebRequest] Returned data: {log_data}')
+        if self.__get_session is not None:
+            data = await _post(self.__get_session(), url, query_params)
+        else:
+            async with aiohttp.ClientSession() as session:
+                data = await _post(session, url, query_params)
 
         result = utils.convert.raw_xml_to_dict(data)
         self.__last_login = utc_now
@@ -160,8 +219,125 @@ class Device():
             self.__can_login_until_changed = True
 
 
+class PooledDevice():
+    """
+    A device of a DevicePool with its own rate limiter.
+    """
+    def __init__(self, device: Device) -> None:
+        self.device: Device = device
+        self.limiter: AdaptiveRateLimiter = AdaptiveRateLimiter(name=f'device {device.key}')
+        self.in_flight: int = 0
+        self.benched_until: float = 0.
+        self.refresher: Optional[asyncio.Task] = None
+
+    @property
+    def load(self) -> float:
+        """
+        Estimated seconds until a new request to this device would be sent.
+        """
+        return (self.limiter.queue_depth + self.in_flight) / self.limiter.rate
+
+
+class DevicePool():
+    """
+    Spreads API requests over several devices, each with its own access token and rate limiter, so that the request rate grows with the number of devices. Every request goes to the least loaded device in rotation.
+
+    A device that cannot log in currently is benched for DEVICE_BENCH_SECONDS. A device that turns out to belong to a real account is dropped and replaced with a new one.
+    """
+    def __init__(self, create_device: Callable[[], Device], on_change: Callable[[List[Device]], None] = None) -> None:
+        self.__create_device: Callable[[], Device] = create_device
+        self.__on_change: Optional[Callable[[List[Device]], None]] = on_change
+        self.__devices: List[PooledDevice] = []
+
+    @property
+    def devices(self) -> List[Device]:
+        return [pooled.device for pooled in self.__devices]
+
+    @property
+    def rate(self) -> float:
+        """
+        Combined request rate of the devices in rotation, in queries per second.
+        """
+        active = self.__active() or self.__devices
+        return sum(pooled.limiter.rate for pooled in active)
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Number of requests waiting for a device.
+        """
+        return sum(pooled.limiter.queue_depth for pooled in self.__devices)
+
+    def add(self, device: Device) -> None:
+        pooled = PooledDevice(device)
+        pooled.refresher = asyncio.create_task(device.keep_access_token_fresh())
+        self.__devices.append(pooled)
+
+    def close(self) -> None:
+        for pooled in self.__devices:
+            pooled.refresher.cancel()
+
+    @asynccontextmanager
+    async def use(self, authorized: bool = True) -> AsyncIterator[Tuple[AdaptiveRateLimiter, Optional[str]]]:
+        """
+        Waits for the rate limiter of the least loaded device and yields the limiter and, for authorized requests, the access token of the device.
+
+        Raises LoginError if no device can log in.
+        """
+        while True:
+            active = self.__active(authorized)
+            if not active:
+                raise LoginError('No device can log in currently.')
+            pooled = min(active, key=lambda candidate: candidate.load)
+            pooled.in_flight += 1
+            try:
+                await pooled.limiter.acquire()
+                token = None
+                if authorized:
+                    try:
+                        token = await pooled.device.get_access_token()
+                    except DeviceInUseError as e:
+                        self.__replace(pooled, e)
+                        continue
+                    except LoginError as e:
+                        log.warning(f'Device {pooled.device.key} benched for {DEVICE_BENCH_SECONDS} s: {e}')
+                        pooled.benched_until = time.monotonic() + DEVICE_BENCH_SECONDS
+                        continue
+                yield pooled.limiter, token
+                return
+            finally:
+                pooled.in_flight -= 1
+
+    def __active(self, authorized: bool = False) -> List[PooledDevice]:
+        now = time.monotonic()
+        return [pooled for pooled in self.__devices
+                if pooled.benched_until <= now
+                and (not authorized or pooled.device.can_login or not pooled.device.access_token_expired)]
+
+    def __replace(self, pooled: PooledDevice, error: Exception) -> None:
+        if pooled not in self.__devices:
+            return
+        log.warning(f'Device {pooled.device.key} replaced: {error}')
+        pooled.refresher.cancel()
+        self.__devices.remove(pooled)
+        self.add(self.__create_device())
+        if self.__on_change is not None:
+            self.__on_change(self.devices)
+
+
 # ---------- Helper functions ----------
 
+async def _post(session: aiohttp.ClientSession, url: str, query_params: dict) -> str:
+    async with session.post(url, params=query_params) as response:
+        data = await response.text(encoding='utf-8')
+        if settings.PRINT_DEBUG_WEB_REQUESTS:
+            log_data = data or ''
+            if log_data and len(log_data) > 100:
+                log_data = log_data[:100]
+            log.debug(f'[WebRequest] Returned data: {log_data}')
+    return data
+
+
 def _create_device_key() -> str:
     h = '0123456789abcdef'
     result = ''.join(
@@ -0,0 +1,87 @@
+import asyncio
+import logging as log
+import time
+from typing import Optional
+
+
+class AdaptiveRateLimiter:
+    """
+    Asyncio token bucket for a rate limited remote service, such as the PSS API.
+
+    The refill rate is adjusted with AIMD: every successful query adds `increase` queries/s to the rate,
+    every throttled response multiplies it by `decrease` and pauses the bucket for `cooldown` seconds. Throttled
+    responses arriving during a pause belong to the same episode, they extend the pause but do not lower the
+    rate again.
+    Waiters are served in FIFO order and never block the event loop.
+    """
+
+    def __init__(self, rate: float = 2.0, min_rate: float = 0.2, max_rate: float = 5.0, increase: float = 0.02,
+                 decrease: float = 0.5, burst: float = 2.0, cooldown: float = 10.0, name: str = "api"):
+        self._rate = rate
+        self._min_rate = min_rate
+        self._max_rate = max_rate
+        self._increase = increase
+        self._decrease = decrease
+        self._burst = burst
+        self._cooldown = cooldown
+        self._name = name
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._waiting = 0
+        self._lock = asyncio.Lock()
+
+    @property
+    def rate(self) -> float:
+        """
+        Current refill rate in queries per second.
+        """
+        return self._rate
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Number of coroutines currently waiting for a token.
+        """
+        return self._waiting
+
+    async def acquire(self) -> None:
+        self._waiting += 1
+        try:
+            async with self._lock:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    wait = self._blocked_until - now
+                    if wait <= 0:
+                        if self._tokens >= 1:
+                            self._tokens -= 1
+                            return
+                        wait = (1 - self._tokens) / self._rate
+                    await asyncio.sleep(wait)
+        finally:
+            self._waiting -= 1
+
+    def on_success(self) -> None:
+        self._rate = min(self._max_rate, self._rate + self._increase)
+
+    def on_throttled(self, cooldown: Optional[float] = None) -> None:
+        """
+        Lowers the rate and pauses the bucket for `cooldown` seconds, or the configured cooldown when the server
+        did not say how long to wait.
+        """
+        now = time.monotonic()
+        self._refill(now)
+        new_episode = now >= self._blocked_until
+        if new_episode:
+            self._rate = max(self._min_rate, self._rate * self._decrease)
+        self._tokens = 0
+        self._blocked_until = max(self._blocked_until, now + (self._cooldown if cooldown is None else cooldown))
+        if new_episode:
+            log.info(f"Rate limiter {self._name}: throttled by server, rate lowered to {self._rate:.2f}/s, "
+                     f"{self._waiting} waiting")
+
+    def _refill(self, now: float) -> None:
+        elapsed = max(0.0, now - max(self._updated, self._blocked_until))
+        self._tokens = min(self._burst, self._tokens + elapsed * self._rate)
+        self._updated = now
@@ -0,0 +1,82 @@
+from typing import Dict, Optional, Tuple
+from pss_api import PSSApi
+from db import AsyncDatabase, to_timestamp
+import logging as log
+import time
+import pandas as pd
+
+
+class SalesHistory:
+    """
+    Sold sales of items, stored locally in the database and topped up from the API on demand.
+
+    For every item the database remembers the time from which its stored sales are complete. A request that
+    is covered by the stored sales only fetches the pages newer than the newest stored sale, anything else
+    is crawled once and stored for the next requests.
+    """
+    TOPUP_INTERVAL_SECONDS = 60
+    TOPUP_MAX_QUERIES = 20
+
+    def __init__(self, api: PSSApi, db: AsyncDatabase):
+        self._api = api
+        self._db = db
+        self._last_topup: Dict[int, float] = {}
+
+    async def get_sales_for_design_id(self, design_id: int, past_days=2, max_count=100,
+                                      max_queries=100) -> Optional[pd.DataFrame]:
+        """
+        Returns the latest Starbux sales of an item in the format of PSSApi.get_sales_for_design_id.
+        """
+        df, _ = await self.get_sales_and_queries(design_id, past_days=past_days, max_count=max_count,
+                                                 max_queries=max_queries)
+        return df
+
+    async def get_sales_and_queries(self, design_id: int, past_days=2, max_count=100,
+                                    max_queries=100) -> Tuple[Optional[pd.DataFrame], int]:
+        """
+        Like get_sales_for_design_id, and also returns the number of API queries it took. At most
+        `max_queries` pages are fetched.
+        """
+        now = time.time()
+        cutoff = to_timestamp(pd.Timestamp.now() - pd.Timedelta(days=past_days))
+        coverage = await self._db.get_sales_coverage(design_id)
+        covered = coverage is not None and \
+            (coverage <= cutoff or await self._db.count_sales(design_id, since=coverage) >= max_count)
+
+        queries = 0
+        if covered:
+            if now - self._last_topup.get(design_id, 0) >= self.TOPUP_INTERVAL_SECONDS:
+                newest_id, newest_time = await self._db.get_newest_sale(design_id)
+                topup_queries = min(self.TOPUP_MAX_QUERIES, max_queries)
+                crawl = await self._api.crawl_sales_for_design_id(
+                    design_id, past_days=past_days, max_count=self._api.SALES_PAGE_SIZE * topup_queries,
+                    max_queries=topup_queries, newer_than_sale_id=newest_id)
+                queries = crawl.queries
+                # A complete crawl only connects to the stored sales if they reach into the requested window
+                await self._store(design_id, crawl.sales, crawl.complete, coverage if newest_time >= cutoff else None,
+                                  cutoff)
+        else:
+            crawl = await self._api.crawl_sales_for_design_id(design_id, past_days=past_days, max_count=max_count,
+                                                              max_queries=max_queries)
+            queries = crawl.queries
+            if crawl.sales is None and not crawl.complete:
+                log.error(f"Failed to get sales for {design_id}")
+                return None, queries
+            await self._store(design_id, crawl.sales, crawl.complete, None, cutoff)
+
+        return await self._db.get_sales(design_id, since=cutoff, max_count=max_count), queries
+
+    async def _store(self, design_id: int, df: Optional[pd.DataFrame], complete: bool, coverage: Optional[int], cutoff: int):
+        if df is None and not complete:
+            return
+        self._last_topup[design_id] = time.time()
+        if df is not None and len(df) > 0:
+            await self._db.insert_sales(df)
+        if complete:
+            # The crawl reached the stored sales, the cutoff or the start of the history
+            oldest = cutoff if coverage is None else min(coverage, cutoff)
+        elif df is not None and len(df) > 0:
+            oldest = to_timestamp(df["StatusDate"].min())
+        else:
+            return
+        await self._db.set_sales_coverage(design_id, oldest)
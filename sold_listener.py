@@ -0,0 +1,109 @@
+from typing import Dict, List
+from items import Items
+from pss_api import PSSApi
+from db import AsyncDatabase
+from sales_history import SalesHistory
+import logging as log
+import asyncio
+import time
+import datetime
+import pandas as pd
+
+
+class SoldListener:
+    """
+    Detects which recorded market listings have been sold, separately from the market polling.
+
+    Items with open listings are checked one at a time in priority order. The priority grows with the number
+    of open listings, the age of the oldest one, the observed sell rate of the item and the time since it was
+    last checked. Checks are spaced by the number of queries they made, so that they use at most `budget_share`
+    of the current API rate, and they give way whenever other queries are waiting for the rate limiter. A check
+    fetches at most CHECK_MAX_QUERIES pages of sales.
+    """
+    RERANK_INTERVAL_SECONDS = 60
+    IDLE_SECONDS = 30
+    SELL_RATE_WINDOW_SECONDS = 24 * 3600
+    COMPACT_INTERVAL_SECONDS = 6 * 3600
+    CHECK_MAX_QUERIES = 1
+
+    def __init__(self, api: PSSApi, items: Items, db: AsyncDatabase, sales: SalesHistory, budget_share: float = 0.25,
+                 raw_retention_days: int = 30):
+        self._api = api
+        self._items = items
+        self._db = db
+        self._sales = sales
+        self._budget_share = budget_share
+        self._raw_retention_seconds = raw_retention_days * 24 * 3600
+        self._last_checked: Dict[int, float] = {}
+        self._next_compaction: float = 0
+
+    async def _rank(self, listings: pd.DataFrame) -> List[int]:
+        now = time.time()
+        sold_counts = await self._db.get_sold_counts(int(now) - self.SELL_RATE_WINDOW_SECONDS)
+        per_item = listings.groupby("item_id")["listing_time"].agg(["count", "min"])
+
+        open_listings = per_item["count"].to_numpy(dtype=float)
+        oldest_age_hours = (now - per_item["min"].to_numpy(dtype=float)) / 3600
+        sold_per_day = per_item.index.map(lambda item_id: sold_counts.get(item_id, 0)).to_numpy(dtype=float)
+        since_checked_minutes = per_item.index.map(
+            lambda item_id: now - self._last_checked.get(item_id, 0)).to_numpy(dtype=float) / 60
+
+        priority = open_listings * (1 + sold_per_day) * (1 + oldest_age_hours / 24) * since_checked_minutes
+        order = priority.argsort()[::-1]
+        return [int(item_id) for item_id in per_item.index[order]]
+
+    async def _wait_for_budget(self, started: float, queries: int):
+        while self._api.limiter.queue_depth > 0:
+            await asyncio.sleep(1)
+        interval = queries / (self._budget_share * self._api.limiter.rate)
+        await asyncio.sleep(max(0., interval - (time.monotonic() - started)))
+
+    async def _check_item(self, item_id: int, listings: pd.DataFrame) -> int:
+        """
+        Marks the sold listings of an item and returns the number of API queries it took.
+        """
+        self._last_checked[item_id] = time.time()
+        sales, queries = await self._sales.get_sales_and_queries(item_id, past_days=1, max_count=20,
+                                                                 max_queries=self.CHECK_MAX_QUERIES)
+        if sales is None:
+            log.error(f"Failed to get sales for {self._items.get_name_by_design_id(item_id)}!")
+            return queries
+        listing_ids = listings.loc[listings["item_id"] == item_id, "listing_id"]
+        sold_time = int(datetime.datetime.utcnow().timestamp())
+        await self._db.mark_sold_many(listing_ids[listing_ids.isin(sales["SaleId"])], sold_time)
+        return queries
+
+    async def _compact(self):
+        """
+        Rolls sold listings older than the raw retention window into daily aggregates, every
+        COMPACT_INTERVAL_SECONDS.
+        """
+        now = time.monotonic()
+        if now < self._next_compaction:
+            return
+        self._next_compaction = now + self.COMPACT_INTERVAL_SECONDS
+        try:
+            await self._db.compact_sold(self._raw_retention_seconds)
+        except Exception as e:
+            log.error(f"Failed to compact sold listings: {e}")
+
+    async def run(self):
+        while True:
+            await self._compact()
+            listings = await self._db.get_listings()
+            if len(listings) == 0:
+                await asyncio.sleep(self.IDLE_SECONDS)
+                continue
+
+            ranked_at = time.monotonic()
+            for item_id in await self._rank(listings):
+                started = time.monotonic()
+                # a failed check is assumed to have used its full query allowance
+                queries = self.CHECK_MAX_QUERIES
+                try:
+                    queries = await self._check_item(item_id, listings)
+                except Exception as e:
+                    log.error(f"Failed to check sold listings for {item_id}: {e}")
+                await self._wait_for_budget(started, queries)
+                if time.monotonic() - ranked_at > self.RERANK_INTERVAL_SECONDS:
+                    break
@@ -0,0 +1,85 @@
+import datetime
+import json
+import logging as log
+import os
+import sqlite3
+import threading
+from typing import Any
+
+import cloudpickle as pickle
+import numpy as np
+
+
+class StateStore:
+    """
+    Small transactional key-value store for the bot state, such as the watched items and the device login,
+    kept in one SQLite file. Values are stored as JSON; datetimes, tuples and dicts with non-string keys are
+    tagged so that they load back as the same types.
+    """
+    FILENAME = "state.db"
+
+    def __init__(self, data_path: str):
+        os.makedirs(data_path, exist_ok=True)
+        self._data_path = data_path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(data_path, self.FILENAME), check_same_thread=False)
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS state(key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0], object_hook=_decode)
+
+    def set(self, key: str, value: Any):
+        text = json.dumps(_encode(value), separators=(",", ":"))
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO state(key, value) VALUES(?, ?)", (key, text))
+
+    def delete(self, key: str):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM state WHERE key = ?", (key,))
+
+    def migrate_pickle(self, key: str, relative_path: str):
+        """
+        Moves a value from a cloudpickle file of the earlier versions to `key`, unless `key` is set already.
+        """
+        filename = os.path.join(self._data_path, relative_path)
+        if not os.path.exists(filename):
+            return
+        if self.get(key) is None:
+            with open(filename, "rb") as infile:
+                self.set(key, pickle.load(infile))
+            log.info(f"Migrated {relative_path} to the state store")
+        os.remove(filename)
+
+    def close(self):
+        self._connection.close()
+
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, dict):
+        if all(isinstance(key, str) for key in value):
+            return {key: _encode(item) for key, item in value.items()}
+        return {"__dict__": [[_encode(key), _encode(item)] for key, item in value.items()]}
+    if isinstance(value, tuple):
+        return {"__tuple__": [_encode(item) for item in value]}
+    if isinstance(value, list):
+        return [_encode(item) for item in value]
+    if isinstance(value, datetime.datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _decode(value: dict) -> Any:
+    if "__dict__" in value:
+        return {key: item for key, item in value["__dict__"]}
+    if "__tuple__" in value:
+        return tuple(value["__tuple__"])
+    if "__datetime__" in value:
+        return datetime.datetime.fromisoformat(value["__datetime__"])
+    return value
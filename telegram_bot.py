@@ -1,7 +1,11 @@
 import asyncio
+from collections import deque
+from typing import Deque, Tuple
 from aiogram import Bot, Dispatcher, types
 from aiogram.types import Message
-from db import Database
+from aiogram.utils.exceptions import RetryAfter, TelegramAPIError
+from db import AsyncDatabase
+from rate_limiter import AdaptiveRateLimiter
 import logging as log
 
 
@@ -22,7 +26,15 @@ def get_item_from_texts(texts) -> (str, int):
 
 
 class TelegramBot:
-    def __init__(self, config, market, items, fleet_listener, db: Database):
+    # Telegram allows about 20 messages per minute to a group and one per second to a private chat
+    MESSAGES_PER_SECOND = 1 / 3
+    MESSAGE_BURST = 3
+    MAX_MESSAGE_LENGTH = 4096
+    # Queued messages are merged into digests once this many are waiting
+    DIGEST_BACKLOG = 3
+    MAX_SEND_ATTEMPTS = 3
+
+    def __init__(self, config, market, items, fleet_listener, db: AsyncDatabase):
         self._config = config
         self._token = config["token"]
         self._chat_id = config["chat_id"]
@@ -32,6 +44,11 @@ class TelegramBot:
         self._items = items
         self._fleet_listener = fleet_listener
         self._db = db
+        self._outbox: Deque[Tuple[str, bool]] = deque()
+        self._outbox_ready = asyncio.Event()
+        self._limiter = AdaptiveRateLimiter(rate=self.MESSAGES_PER_SECOND, min_rate=self.MESSAGES_PER_SECOND / 4,
+                                            max_rate=self.MESSAGES_PER_SECOND, increase=self.MESSAGES_PER_SECOND / 20,
+                                            burst=self.MESSAGE_BURST, cooldown=30, name="telegram")
         self._setup_message_handlers()
 
     def _setup_message_handlers(self):
@@ -234,9 +251,9 @@ class TelegramBot:
             else:
                 name = ' '.join(name_parts[1:])
                 item_id = self._items.get_design_id_by_name(name)
-                df = self._db.get_sold_prices(item_id, stat, stat_amount)
-                if len(df) > 0:
-                    reply = f"{name} - {len(df)} samples - min {df.mean()['price']} - max {df.max()['price']} - mean {df.mean(numeric_only=True)['price']}"
+                summary = await self._db.get_sold_price_summary(item_id, stat, stat_amount)
+                if summary is not None:
+                    reply = f"{name} - {summary['count']} samples - min {summary['min']} - max {summary['max']} - mean {summary['mean']:.0f} - median {summary['median']:.0f}"
                 else:
                     reply = "No data"
 
@@ -268,10 +285,53 @@ class TelegramBot:
             await message.answer("Nice try!")
 
     async def run(self):
-        await self._dp.start_polling(self._bot)
+        await asyncio.gather(
+            self._dp.start_polling(self._bot),
+            self._send_outbox())
 
     async def send_message(self, message: str, html=False):
-        if html:
-            await self._bot.send_message(self._chat_id, message, parse_mode="HTML", disable_web_page_preview=True)
-        else:
-            await self._bot.send_message(self._chat_id, message, disable_web_page_preview=True)
+        """
+        Queues a message to the chat. Messages are sent in order by a background task within Telegram's rate
+        limits, and merged into digests when they are queued faster than they can be sent.
+        """
+        self._outbox.append((message, html))
+        self._outbox_ready.set()
+
+    def _take_outgoing(self) -> Tuple[str, bool]:
+        message, html = self._outbox.popleft()
+        if len(self._outbox) >= self.DIGEST_BACKLOG:
+            while self._outbox and self._outbox[0][1] == html and \
+                    len(message) + 1 + len(self._outbox[0][0]) <= self.MAX_MESSAGE_LENGTH:
+                message += "\n" + self._outbox.popleft()[0]
+        return message, html
+
+    async def _send_outbox(self):
+        while True:
+            if not self._outbox:
+                self._outbox_ready.clear()
+                await self._outbox_ready.wait()
+                continue
+            await self._limiter.acquire()
+            message, html = self._take_outgoing()
+            await self._deliver(message, html)
+
+    async def _deliver(self, message: str, html: bool):
+        for _ in range(self.MAX_SEND_ATTEMPTS):
+            try:
+                if html:
+                    await self._bot.send_message(self._chat_id, message, parse_mode="HTML", disable_web_page_preview=True)
+                else:
+                    await self._bot.send_message(self._chat_id, message, disable_web_page_preview=True)
+                self._limiter.on_success()
+                return
+            except RetryAfter as e:
+                log.warning(f"Telegram flood control, retrying in {e.timeout} s, {len(self._outbox)} messages queued")
+                self._limiter.on_throttled(cooldown=e.timeout)
+                await self._limiter.acquire()
+            except TelegramAPIError as e:
+                log.error(f"Failed to send message: {e}")
+                return
+            except Exception as e:
+                log.error(f"Failed to send message, retrying: {e}")
+                await self._limiter.acquire()
+        log.error(f"Giving up sending message: {message}")
@@ -1,7 +1,10 @@
-from typing import Any as _Any, Dict, List, Union
+from collections.abc import Mapping as _Mapping
+from typing import Any as _Any, Dict, Iterator, List, Optional, Union
 from urllib.parse import quote as _quote
 from xml.etree import ElementTree as _ElementTree
 
+from lxml import etree as _etree
+
 from . import format as _format
 from . import parse as _parse
 
@@ -15,6 +18,35 @@ from typehints import EntitiesData
 _EntityDict = Union[List['_EntityDict'], Dict[str, '_EntityDict']]
 
 
+# ---------- Classes ----------
+
+class LazyXmlDict(_Mapping):
+    """
+    Read-only mapping of an XML document embedded in an attribute, converted by raw_xml_to_dict on first access.
+    """
+    __slots__ = ('__raw_xml', '__converted')
+
+    def __init__(self, raw_xml: str) -> None:
+        self.__raw_xml: str = raw_xml
+        self.__converted: Optional[_EntityDict] = None
+
+    def __get(self) -> _EntityDict:
+        if self.__converted is None:
+            self.__converted = raw_xml_to_dict(self.__raw_xml)
+        return self.__converted
+
+    def __getitem__(self, key: str) -> _EntityDict:
+        return self.__get()[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.__get())
+
+    def __len__(self) -> int:
+        return len(self.__get())
+
+    def __repr__(self) -> str:
+        return repr(self.__get())
+
 
 
 
@@ -54,6 +86,21 @@ def pss_timestamp_to_excel(pss_timestamp: str) -> str:
 
 
 def raw_xml_to_dict(raw_xml: str, include_root: bool = True, fix_attributes: bool = True, preserve_lists: bool = False) -> _EntityDict:
+    """
+    Converts an XML document to nested dicts in a single pass over the lxml tree. Documents embedded in *Xml
+    attributes are converted lazily, when they are first accessed.
+    """
+    if isinstance(raw_xml, str):
+        raw_xml = raw_xml.encode('utf-8')
+    root = _etree.fromstring(raw_xml, parser=__XML_PARSER)
+    result = __convert_lxml_to_dict(root, include_root=include_root, fix_attributes=fix_attributes, preserve_lists=preserve_lists)
+    return result
+
+
+def raw_xml_to_dict_etree(raw_xml: str, include_root: bool = True, fix_attributes: bool = True, preserve_lists: bool = False) -> _EntityDict:
+    """
+    ElementTree based predecessor of raw_xml_to_dict, kept as a reference for benchmarks.
+    """
     root = _ElementTree.fromstring(raw_xml)
     result = __convert_xml_to_dict(root, include_root=include_root, fix_attributes=fix_attributes, preserve_lists=preserve_lists)
     return result
@@ -112,6 +159,82 @@ def xmltree_to_dict3(raw_text: str) -> EntitiesData:
 
 # ---------- Helper functions ----------
 
+__XML_PARSER = _etree.XMLParser(remove_comments=True, remove_pis=True, huge_tree=True)
+
+
+def __convert_lxml_to_dict(root: _etree._Element, include_root: bool = True, fix_attributes: bool = True, preserve_lists: bool = False) -> _EntityDict:
+    if root is None:
+        return None
+
+    result = {}
+    attributes = dict(root.items())
+    if attributes:
+        if fix_attributes:
+            attributes = __fix_attribute_lazy(attributes)
+        if include_root:
+            result[root.tag] = attributes
+        else:
+            result = attributes
+    elif include_root:
+        result[root.tag] = {}
+
+    if not len(root):
+        return result
+
+    # Tags are counted while collecting the children, so that the children are only walked once more below.
+    children = []
+    tag_count_map = {}
+    for child in root:
+        tag = child.tag
+        if tag.__class__ is str:
+            children.append(child)
+            tag_count_map[tag] = tag_count_map.get(tag, 0) + 1
+
+    children_dict = {}
+    for child in children:
+        tag = child.tag
+        key = None
+        if tag_count_map[tag] > 1:
+            id_attr_names = _pss_data.ID_NAMES_INFO.get(tag)
+            if id_attr_names:
+                id_attr_values = [child.get(id_attr_name) for id_attr_name in id_attr_names]
+                key = '.'.join(sorted(id_attr_values))
+        if not key:
+            key = tag
+
+        if key not in children_dict:
+            children_dict[key] = __convert_lxml_to_dict(child, include_root=False, fix_attributes=fix_attributes, preserve_lists=preserve_lists)
+
+    if children_dict:
+        if preserve_lists:
+            if len(children_dict) > 1:
+                children_list = list(children_dict.values())
+                if include_root:
+                    result[root.tag] = children_list
+                else:
+                    if result:
+                        result['Collection'] = children_list
+                    else:
+                        result = children_list
+            else:
+                result.setdefault(root.tag, {}).update(children_dict)
+        else:
+            if include_root:
+                # keys get overwritten here
+                result[root.tag] = children_dict
+            else:
+                result.update(children_dict)
+
+    return result
+
+
+def __fix_attribute_lazy(attribute: Dict[str, str]) -> Dict[str, str]:
+    for key, value in list(attribute.items()):
+        if value and key.endswith('Xml'):
+            attribute[key[:-3]] = LazyXmlDict(value)
+    return attribute
+
+
 def __convert_xml_to_dict(root: _ElementTree.Element, include_root: bool = True, fix_attributes: bool = True, preserve_lists: bool = False) -> _EntityDict:
     if root is None:
         return None
@@ -182,7 +305,7 @@ def __fix_attribute(attribute: Dict[str, str]) -> Dict[str, str]:
     for key, value in attribute.items():
         if key.endswith('Xml') and value:
             raw_xml = value
-            fixed_value = raw_xml_to_dict(raw_xml)
+            fixed_value = raw_xml_to_dict_etree(raw_xml)
             result[key[:-3]] = fixed_value
 
         result[key] = value
@@ -207,7 +330,7 @@ def __xmltree_to_dict(raw_text: str, depth: int) -> EntitiesData:
     while depth > 0:
         found_new_root = False
         for value in result.values():
-            if isinstance(value, dict):
+            if isinstance(value, _Mapping):
                 result = value
                 depth -= 1
                 found_new_root = True
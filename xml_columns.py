@@ -0,0 +1,156 @@
+import io
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from lxml import etree
+
+ROW = "Row"
+
+
+class Columns:
+    """
+    Attributes of the rows of an API response as one typed numpy array per attribute. Integer and float
+    attributes get numeric arrays, dates datetime64 arrays and everything else object arrays of strings.
+    """
+
+    def __init__(self, columns: Dict[str, np.ndarray], length: int):
+        self._columns = columns
+        self._length = length
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._columns
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self._columns[name]
+
+    def get(self, name: str, default: Any = None) -> np.ndarray:
+        """
+        Returns a column, or an array filled with `default` if no row had the attribute.
+        """
+        if name in self._columns:
+            return self._columns[name]
+        return np.full(self._length, default)
+
+    @property
+    def names(self) -> List[str]:
+        return list(self._columns)
+
+    def with_column(self, name: str, values: np.ndarray) -> "Columns":
+        columns = dict(self._columns)
+        columns[name] = values
+        return Columns(columns, self._length)
+
+    def take(self, rows: Union[np.ndarray, Sequence[int]]) -> "Columns":
+        """
+        Returns the rows selected by a boolean mask or by row indices.
+        """
+        rows = np.asarray(rows)
+        length = int(rows.sum()) if rows.dtype == bool else len(rows)
+        return Columns({name: values[rows] for name, values in self._columns.items()}, length)
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self._columns, index=pd.RangeIndex(self._length))
+
+
+def parse_columns(text: str, parent: str, tag: str, dates: Iterable[str] = ()) -> Columns:
+    """
+    Streams the attributes of every `tag` element inside a `parent` element into Columns. Elements are cleared
+    as soon as they have been read, so memory use does not grow with the tree even on the largest responses.
+
+    Raises ValueError if the response has no `parent` element, e.g. when the API returned an error instead.
+    """
+    rows, _ = parse_nested_columns(text, parent, tag, None, dates=dates)
+    return rows
+
+
+def parse_nested_columns(text: str, parent: str, tag: str, child: Optional[str],
+                         dates: Iterable[str] = ()) -> Tuple[Columns, Optional[Columns]]:
+    """
+    Like parse_columns, and also streams the attributes of every `child` element below a `tag` element into a
+    second Columns, in which the ROW column holds the position of the owning `tag` row.
+    """
+    dates = set(dates)
+    rows = _ColumnBuilder()
+    children = _ColumnBuilder() if child is not None else None
+    tags = (parent, tag) if child is None else (parent, tag, child)
+    inside_row = False
+    found_parent = False
+    parser_events = etree.iterparse(io.BytesIO(text.encode("utf-8")), events=("start", "end"), tag=tags,
+                                    huge_tree=True, remove_comments=True)
+    for event, element in parser_events:
+        if element.tag == parent:
+            found_parent = True
+        elif element.tag == tag:
+            inside_row = event == "start"
+            if not inside_row:
+                rows.add(element.items())
+                element.clear(keep_tail=True)
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+        elif event == "end" and inside_row:
+            children.add(element.items() + [(ROW, rows.length)])
+
+    if not found_parent:
+        raise ValueError(f"Response has no {parent} element")
+    return rows.build(dates), children.build(dates) if children is not None else None
+
+
+class _ColumnBuilder:
+    """
+    Collects attribute strings per column, padding the columns missing from a row with None.
+    """
+
+    def __init__(self):
+        self.values: Dict[str, List[Optional[str]]] = {}
+        self.length = 0
+
+    def add(self, attributes: List[Tuple[str, Any]]):
+        for name, value in attributes:
+            column = self.values.get(name)
+            if column is None:
+                column = self.values[name] = [None] * self.length
+            column.append(value)
+        self.length += 1
+        for column in self.values.values():
+            if len(column) < self.length:
+                column.append(None)
+
+    def build(self, dates: Set[str]) -> Columns:
+        return Columns({name: _to_array(column, name in dates) for name, column in self.values.items()}, self.length)
+
+
+def _to_array(values: List[Optional[str]], is_date: bool) -> np.ndarray:
+    """
+    Converts attribute strings to the narrowest of int64, float64 (missing values as NaN), datetime64 for date
+    columns or object. The first present value decides which conversion is attempted.
+    """
+    if is_date:
+        return np.array(values, dtype="datetime64[ns]")
+
+    sample = next((value for value in values if value is not None), None)
+    if isinstance(sample, int):
+        return np.array(values, dtype=np.int64)
+    if sample is not None:
+        try:
+            float(sample)
+        except ValueError:
+            sample = None
+    if sample is not None:
+        missing = any(value is None for value in values)
+        if not missing:
+            try:
+                return np.array(values, dtype=np.int64)
+            except ValueError:
+                pass
+        try:
+            return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+        except ValueError:
+            pass
+
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array